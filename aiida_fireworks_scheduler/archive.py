@@ -0,0 +1,281 @@
+"""
+Archiving finished AiiDA jobs out of the working collections of the LaunchPad
+
+The documents are moved either to archive collections (``<collection>_archive``)
+in the same database or to compressed JSONL files, so that the collections that
+are queried for running jobs stay small.
+"""
+import gzip
+import os
+from datetime import datetime, timedelta
+
+from bson import json_util
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+from fireworks.core.launchpad import WFLock
+
+from aiida_fireworks_scheduler.common import RESERVED_CATEGORY
+from aiida_fireworks_scheduler.hold import workflow_state
+
+ARCHIVE_SUFFIX = '_archive'
+COLLECTIONS = ('fireworks', 'launches', 'workflows')
+
+
+def get_archive_query(fizzled_days=30):
+    """
+    Return the query for the AiiDA Fireworks that can be archived.
+
+    :param fizzled_days: FIZZLED jobs are only archived if they have not been
+      updated for this number of days.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=fizzled_days)
+    return {
+        'spec._category':
+        RESERVED_CATEGORY,
+        '$or': [
+            {
+                'state': {
+                    '$in': ['COMPLETED', 'DEFUSED']
+                }
+            },
+            # updated_on may be stored either as a string or a datetime
+            {
+                'state': 'FIZZLED',
+                'updated_on': {
+                    '$lt': cutoff.isoformat()
+                }
+            },
+            {
+                'state': 'FIZZLED',
+                'updated_on': {
+                    '$lt': cutoff
+                }
+            },
+        ]
+    }
+
+
+def _average_size(launchpad, collection):
+    """Average size of the documents in a collection, zero if not available"""
+    try:
+        return launchpad.db.command('collstats',
+                                    collection).get('avgObjSize', 0)
+    except OperationFailure:
+        return 0
+
+
+def _count_archived_workflows(launchpad, query, batch_size=1000):
+    """
+    Count the workflows that have all their Fireworks matched by the query, which
+    are those archived with them. Grouped workflows with other jobs left are not.
+    """
+    fw_ids = {
+        doc['fw_id']
+        for doc in launchpad.fireworks.find(query, {
+            'fw_id': 1,
+            '_id': 0
+        })
+    }
+    ordered = sorted(fw_ids)
+    seen = set()
+    count = 0
+    for start in range(0, len(ordered), batch_size):
+        for doc in launchpad.workflows.find(
+            {'nodes': {
+                '$in': ordered[start:start + batch_size]
+            }}, {'nodes': 1}):
+            if doc['_id'] in seen:
+                continue
+            seen.add(doc['_id'])
+            if fw_ids.issuperset(doc['nodes']):
+                count += 1
+    return count
+
+
+def estimate_archive(launchpad, query):
+    """
+    Estimate the number of documents and the space that archiving will reclaim
+
+    :returns: A dictionary of {collection: {'count': ..., 'bytes': ...}}
+    """
+    pipeline = [{
+        '$match': query
+    }, {
+        '$group': {
+            '_id': None,
+            'count': {
+                '$sum': 1
+            },
+            'launches': {
+                '$sum': {
+                    '$add': [{
+                        '$size': {
+                            '$ifNull': ['$launches', []]
+                        }
+                    }, {
+                        '$size': {
+                            '$ifNull': ['$archived_launches', []]
+                        }
+                    }]
+                }
+            }
+        }
+    }]
+    result = list(launchpad.fireworks.aggregate(pipeline))
+    nfws = result[0]['count'] if result else 0
+    nlaunches = result[0]['launches'] if result else 0
+    # A workflow may hold several AiiDA jobs if the submissions are grouped
+    counts = {
+        'fireworks': nfws,
+        'launches': nlaunches,
+        'workflows': _count_archived_workflows(launchpad, query)
+    }
+    return {
+        name: {
+            'count': count,
+            'bytes': int(count * _average_size(launchpad, name))
+        }
+        for name, count in counts.items()
+    }
+
+
+class _JsonlStore:
+    """Append documents to compressed JSONL files, one per collection"""
+    def __init__(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+
+    def store(self, collection, docs):
+        """Append the documents to the file of the collection"""
+        fname = os.path.join(self.output_dir, f'{collection}.jsonl.gz')
+        with gzip.open(fname, 'at') as handle:
+            for doc in docs:
+                handle.write(json_util.dumps(doc) + '\n')
+
+
+class _CollectionStore:
+    """Store documents in the archive collections of the same database"""
+    def __init__(self, launchpad):
+        self.launchpad = launchpad
+
+    def store(self, collection, docs):
+        """Upsert the documents so that interrupted runs can be repeated"""
+        if not docs:
+            return
+        self.launchpad.db[collection + ARCHIVE_SUFFIX].bulk_write(
+            [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in docs],
+            ordered=False)
+
+
+def _remove_nodes(launchpad, wf_docs, fw_ids):
+    """
+    Remove the archived Fireworks from the workflows that still have others, so that
+    these can still be loaded
+
+    Each workflow is updated while holding its lock, as the other Fireworks in it
+    may be checked out or completed at the same time. The lock is forced if it is
+    not released in time, since the archived Fireworks are already deleted.
+
+    :param wf_docs: The documents of the workflows.
+    :param fw_ids: A set of the ids of the archived Fireworks.
+    """
+    for doc in wf_docs:
+        anchor = next(fw_id for fw_id in doc['nodes'] if fw_id not in fw_ids)
+        with WFLock(launchpad, anchor, kill=True):
+            doc = launchpad.workflows.find_one({'_id': doc['_id']}, {
+                'nodes': 1,
+                'fw_states': 1
+            })
+            archived = [fw_id for fw_id in doc['nodes'] if fw_id in fw_ids]
+            if not archived:
+                continue
+            fw_states = {
+                key: state
+                for key, state in doc['fw_states'].items()
+                if int(key) not in fw_ids
+            }
+            launchpad.workflows.update_one({'_id': doc['_id']}, {
+                '$pull': {
+                    'nodes': {
+                        '$in': archived
+                    }
+                },
+                '$unset': {
+                    field: ''
+                    for fw_id in archived
+                    for field in (f'links.{fw_id}', f'fw_states.{fw_id}')
+                },
+                '$set': {
+                    'state': workflow_state(fw_states),
+                    'updated_on': datetime.utcnow()
+                }
+            })
+
+
+def archive_jobs(launchpad, query, batch_size=1000, output_dir=None):
+    """
+    Move the matching Fireworks, with their launches and workflows, out of the
+    working collections.
+
+    The documents are stored before being deleted, in batches of `batch_size`
+    Fireworks. A workflow is archived once none of its Fireworks are left in the
+    working collection. The Fireworks archived from a workflow with other Fireworks
+    left, such as a group of jobs, are removed from it.
+
+    :param launchpad: The `LaunchPad` to archive
+    :param query: Query of the Fireworks to archive, see `get_archive_query`
+    :param batch_size: Number of Fireworks to move per batch
+    :param output_dir: If given, write compressed JSONL files to this folder instead
+      of using archive collections.
+
+    :returns: A dictionary of the number of documents archived per collection
+    """
+    if output_dir:
+        store = _JsonlStore(output_dir)
+    else:
+        store = _CollectionStore(launchpad)
+
+    totals = {name: 0 for name in COLLECTIONS}
+    while True:
+        fw_docs = list(launchpad.fireworks.find(query).limit(batch_size))
+        if not fw_docs:
+            break
+        fw_ids = [doc['fw_id'] for doc in fw_docs]
+        launch_ids = [
+            launch_id for doc in fw_docs for launch_id in
+            doc.get('launches', []) + doc.get('archived_launches', [])
+        ]
+        launch_docs = list(
+            launchpad.launches.find({'launch_id': {
+                '$in': launch_ids
+            }}))
+
+        store.store('fireworks', fw_docs)
+        store.store('launches', launch_docs)
+        launchpad.launches.delete_many({'launch_id': {'$in': launch_ids}})
+        launchpad.fireworks.delete_many({'fw_id': {'$in': fw_ids}})
+
+        # Only archive the workflows that have no Fireworks left
+        wf_docs = list(launchpad.workflows.find({'nodes': {'$in': fw_ids}}))
+        nodes = [fw_id for doc in wf_docs for fw_id in doc['nodes']]
+        remaining = set(
+            launchpad.fireworks.distinct('fw_id', {'fw_id': {
+                '$in': nodes
+            }}))
+        _remove_nodes(
+            launchpad,
+            [doc for doc in wf_docs if remaining.intersection(doc['nodes'])],
+            set(fw_ids))
+        wf_docs = [
+            doc for doc in wf_docs if not remaining.intersection(doc['nodes'])
+        ]
+        store.store('workflows', wf_docs)
+        launchpad.workflows.delete_many(
+            {'_id': {
+                '$in': [doc['_id'] for doc in wf_docs]
+            }})
+
+        totals['fireworks'] += len(fw_docs)
+        totals['launches'] += len(launch_docs)
+        totals['workflows'] += len(wf_docs)
+    return totals
@@ -8,15 +8,26 @@ import click
 
 import aiida.cmdline.utils.echo as echo
 from aiida.cmdline.utils.decorators import with_dbenv
-from aiida.cmdline.params import options
+from aiida.cmdline.params import options, types
 from aiida.cmdline.commands.cmd_data import verdi_data
 
-from aiida_fireworks_scheduler.common import DEFAULT_USERNAME
+from aiida_fireworks_scheduler.common import (DEFAULT_USERNAME,
+                                              FW_SCHEDULER_TYPES,
+                                              SETTINGS_PROPERTY)
 from aiida_fireworks_scheduler.fworker import AiiDAFWorker
+from aiida_fireworks_scheduler.launchpads import MIN_MAX_STALENESS
 
 # pylint: disable=import-outside-toplevel,no-member
 
 
+def _validate_max_staleness(ctx, param, value):  # pylint: disable=unused-argument
+    """Accept -1 (no limit) or the values allowed by MongoDB"""
+    if value is not None and value != -1 and value < MIN_MAX_STALENESS:
+        raise click.BadParameter(
+            f'must be -1 or at least {MIN_MAX_STALENESS} seconds.')
+    return value
+
+
 @verdi_data.group("fireworks-scheduler")
 def fw_cli():
     """Command line interface for aiida-fireworks-scheduler"""
@@ -108,34 +119,413 @@ def duplicate_fe(computer: Computer, include_codes, input_plugin, suffix,
 @fw_cli.command("generate-worker")
 @options.COMPUTER()
 @click.option("--mpinp", type=int, help="Number of MPI processes.")
+@click.option("--min-mpinp",
+              type=int,
+              help="Also run smaller jobs with at least this number of MPI "
+              "processes, preferring the largest.")
+@click.option("--max-mpinp",
+              type=int,
+              help="Run jobs with up to this number of MPI processes, "
+              "preferring the largest.")
 @click.option("--name", type=str, help="Name of the worker.")
 @click.option("--category",
               type=str,
               multiple=True,
               help="Categories of the NON-AIIDA jobs for the worker to run.")
+@click.option(
+    "--stage-dir",
+    type=str,
+    help="Node-local folder (e.g. $TMPDIR) to run the AiiDA jobs in.")
+@click.option(
+    "--cache-login-env",
+    is_flag=True,
+    default=False,
+    help="Capture the login environment once per allocation for the jobs.")
+@click.option(
+    "--usage-interval",
+    type=int,
+    help="Sample the resource usage of the jobs at this interval in seconds.")
+@click.option(
+    "--estimate-walltime",
+    is_flag=True,
+    default=False,
+    help="Select the jobs by the runtime predicted from the completed jobs.")
+@click.option(
+    "--username",
+    type=str,
+    multiple=True,
+    help=
+    "User names of the jobs to run, default to that of the computer. Can be used multiple times."
+)
+@click.option(
+    "--fair-share",
+    is_flag=True,
+    default=False,
+    help="Run the jobs of the user with the least recent usage first.")
+@click.option(
+    "--add-computer",
+    type=types.ComputerParamType(),
+    multiple=True,
+    help=
+    "Also run the jobs of another computer, with the user name of its configuration. Can be used multiple times."
+)
+@click.option(
+    "--checkout-order",
+    type=click.Choice(AiiDAFWorker.CHECKOUT_ORDERS),
+    default='aiida',
+    show_default=True,
+    help="Whether the AiiDA jobs or the other Fireworks are tried first.")
 @click.argument('output_file')
-def generate_worker(computer, mpinp, name, output_file, category):
+def generate_worker(computer, mpinp, min_mpinp, max_mpinp, name, output_file,
+                    category, stage_dir, cache_login_env, usage_interval,
+                    estimate_walltime, username, fair_share, add_computer,
+                    checkout_order):  # pylint: disable=too-many-arguments
     """Generate worker fire for a particular computer"""
 
-    if computer.scheduler_type not in [
-            "fireworks", "fireworks_scheduler.default",
-            "fireworks_scheduler.keepenv"
-    ]:
+    if computer.scheduler_type not in FW_SCHEDULER_TYPES:
         echo.echo_critical(
             "Can only generate worker for computer using 'fireworks' scheduler."
         )
         return
 
     hostname = computer.hostname
-    config = computer.get_configuration()
-    username = config.get('username', DEFAULT_USERNAME)
+    if not username:
+        config = computer.get_configuration()
+        username = config.get('username', DEFAULT_USERNAME)
+    elif len(username) == 1:
+        username = username[0]
+    else:
+        username = list(username)
+
+    computers = []
+    for other in add_computer:
+        if other.scheduler_type not in FW_SCHEDULER_TYPES:
+            echo.echo_critical(
+                f"Computer {other.label} does not use the 'fireworks' scheduler."
+            )
+            return
+        computers.append([
+            other.hostname,
+            other.get_configuration().get('username', DEFAULT_USERNAME)
+        ])
 
     if name is None:
         name = f"Worker on {hostname} for {username} with mpinp: {mpinp}"
 
     worker = AiiDAFWorker(computer_id=hostname,
                           mpinp=mpinp,
+                          min_mpinp=min_mpinp,
+                          max_mpinp=max_mpinp,
                           username=username,
                           name=name,
-                          category=category)
+                          category=category,
+                          stage_dir=stage_dir,
+                          cache_login_env=cache_login_env,
+                          usage_interval=usage_interval,
+                          walltime_estimator=estimate_walltime or None,
+                          fair_share=fair_share or None,
+                          computers=computers,
+                          checkout_order=checkout_order)
     worker.to_file(output_file)
+
+
+@fw_cli.command("configure-computer")
+@options.COMPUTER()
+@click.option(
+    '--launchpad',
+    type=str,
+    help='Path to the launchpad file or MongoDB URI to use for this computer.')
+@click.option('--max-pool-size',
+              type=int,
+              help='Maximum number of connections to the LaunchPad.')
+@click.option(
+    '--launchpad-timeout',
+    type=int,
+    help=
+    'Seconds to wait for the LaunchPad before the operation is retried (default: 10).'
+)
+@click.option('--read-preference',
+              type=click.Choice([
+                  'primary', 'primaryPreferred', 'secondary',
+                  'secondaryPreferred', 'nearest'
+              ]),
+              help='Read preference for polling the job states.')
+@click.option(
+    '--max-staleness',
+    type=int,
+    callback=_validate_max_staleness,
+    help=
+    'Maximum replication lag in seconds (>= 90, or -1 for no limit) of the secondaries to poll from.'
+)
+@click.option(
+    '--stage-dir',
+    type=str,
+    help='Node-local folder (e.g. $TMPDIR) to run the jobs in on the remote.')
+@click.option(
+    '--aging-interval',
+    type=int,
+    help='Raise the priority of waiting jobs after every this many seconds.')
+@click.option('--aging-increment',
+              type=int,
+              help='Increment of the priority for aging (default: 10).')
+@click.option(
+    '--aging-max-levels',
+    type=int,
+    help='Maximum number of increments of the priority for aging (default: 10).'
+)
+@click.option(
+    '--group-window',
+    type=int,
+    help='Add the jobs submitted within this many seconds to the same workflow.'
+)
+@click.option('--group-size',
+              type=int,
+              help='Maximum number of jobs in a workflow (default: 100).')
+@click.option(
+    '--max-queued',
+    type=int,
+    help='Delay the submissions while this many jobs are waiting to run.')
+@click.option(
+    '--max-requeues',
+    type=int,
+    help='Requeue the jobs killed at their walltime up to this many times.')
+@click.option(
+    '--requeue-factor',
+    type=float,
+    help='Factor raising the walltime of the requeued jobs (default: 1.5).')
+@click.option(
+    '--recover-lost-jobs',
+    type=click.Choice(['rerun', 'fizzle']),
+    help='Run again, or mark as failed, the jobs whose lease has expired.')
+@click.option('--unset',
+              type=str,
+              multiple=True,
+              help='Name of a setting to remove.')
+@with_dbenv()
+def configure_computer(computer, unset, **kwargs):
+    """
+    Set the settings of the fireworks scheduler for a computer.
+
+    Only the settings that are passed are changed, the current settings are shown
+    afterwards.
+    """
+    if computer.scheduler_type not in FW_SCHEDULER_TYPES:
+        echo.echo_critical(
+            "Can only configure computer using 'fireworks' scheduler.")
+        return
+
+    settings = dict(computer.get_property(SETTINGS_PROPERTY, {}))
+    for key, value in kwargs.items():
+        if value is not None:
+            settings[key] = value
+    for key in unset:
+        settings.pop(key.replace('-', '_'), None)
+    computer.set_property(SETTINGS_PROPERTY, settings)
+
+    for key, value in sorted(settings.items()):
+        echo.echo(f"{key}: {value}")
+
+
+@fw_cli.command("archive")
+@click.option('--fizzled-days',
+              type=int,
+              default=30,
+              show_default=True,
+              help='Archive FIZZLED jobs not updated for this many days.')
+@click.option('--batch-size',
+              type=int,
+              default=1000,
+              show_default=True,
+              help='Number of Fireworks to move in each batch.')
+@click.option(
+    '--output-dir',
+    type=click.Path(file_okay=False),
+    help=
+    'Write compressed JSONL files to this folder instead of archive collections.'
+)
+@click.option('--launchpad-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help='LaunchPad file to use instead of the default one.')
+@options.DRY_RUN()
+@options.FORCE()
+def archive(fizzled_days, batch_size, output_dir, launchpad_file, dry_run,
+            force):
+    """
+    Move finished AiiDA jobs out of the working collections of the LaunchPad.
+
+    COMPLETED and DEFUSED jobs, and FIZZLED jobs that have not been updated
+    recently, are archived together with their launches and workflows.
+    """
+    from aiida_fireworks_scheduler.launchpads import get_launchpad
+    from aiida_fireworks_scheduler.archive import (get_archive_query,
+                                                   estimate_archive,
+                                                   archive_jobs)
+
+    lpad = get_launchpad(launchpad_file)
+    query = get_archive_query(fizzled_days)
+
+    estimate = estimate_archive(lpad, query)
+    for name, item in estimate.items():
+        echo.echo_info(f"{name}: {item['count']} documents, "
+                       f"about {item['bytes'] / 1024 ** 2:.1f} MiB")
+    if dry_run:
+        echo.echo_info("This is a dry-run nothing has been archived.")
+        return
+    if estimate['fireworks']['count'] == 0:
+        echo.echo_info("Nothing to archive.")
+        return
+    if not force:
+        click.confirm('Archive these documents?', abort=True)
+
+    totals = archive_jobs(lpad,
+                          query,
+                          batch_size=batch_size,
+                          output_dir=output_dir)
+    echo.echo_success("Archived " + ", ".join(
+        f"{count} {name}" for name, count in totals.items()))
+
+
+@fw_cli.command("age-priorities")
+@click.option('--interval',
+              type=int,
+              required=True,
+              help='Raise the priority after every this many seconds of waiting.')
+@click.option('--increment',
+              type=int,
+              default=10,
+              show_default=True,
+              help='Increment of the priority.')
+@click.option('--max-levels',
+              type=int,
+              default=10,
+              show_default=True,
+              help='Maximum number of increments.')
+@click.option('--launchpad-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help='LaunchPad file to use instead of the default one.')
+def age_priorities(interval, increment, max_levels, launchpad_file):
+    """
+    Raise the priority of the AiiDA jobs waiting to run.
+
+    This can be run periodically (e.g. with cron) instead of setting
+    ``aging_interval`` for the computers.
+    """
+    from aiida_fireworks_scheduler.launchpads import get_launchpad
+    from aiida_fireworks_scheduler import maintenance
+
+    nupdated = maintenance.age_priorities(get_launchpad(launchpad_file),
+                                          interval,
+                                          increment=increment,
+                                          max_levels=max_levels)
+    echo.echo_success(f"Raised the priority {nupdated} times.")
+
+
+@fw_cli.command("stats")
+@click.option('--state',
+              type=str,
+              multiple=True,
+              help='States of the jobs to include, default to the active ones. '
+              'Can be used multiple times.')
+@click.option('--computer-id',
+              type=str,
+              help='Only include the jobs of the computer with this host name.')
+@click.option('--json',
+              'json_file',
+              type=click.Path(dir_okay=False),
+              help='Also write the statistics to this JSON file.')
+@click.option('--launchpad-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help='LaunchPad file to use instead of the default one.')
+def stats(state, computer_id, json_file, launchpad_file):
+    """
+    Show the statistics of the AiiDA jobs in the LaunchPad.
+
+    The jobs are counted by computer, user, number of MPI processes, walltime
+    and state, with the total core-hours requested and the age of the oldest job.
+    """
+    import json
+    from tabulate import tabulate
+    from aiida_fireworks_scheduler.launchpads import get_launchpad
+    from aiida_fireworks_scheduler.stats import get_stats, STATS_FIELDS
+
+    rows = get_stats(get_launchpad(launchpad_file),
+                     states=state or None,
+                     computer_id=computer_id)
+    if json_file:
+        with open(json_file, 'w') as fhandle:
+            json.dump(rows, fhandle, indent=2)
+    if not rows:
+        echo.echo_info("No jobs found.")
+        return
+
+    table = []
+    for row in rows:
+        bucket = row['walltime_bucket']
+        age = row['oldest_age']
+        table.append([
+            row['computer_id'], row['username'], row['mpinp'],
+            f"<={bucket / 3600:g}h" if bucket else 'longer', row['state'],
+            row['count'], f"{row['core_seconds'] / 3600:.1f}",
+            f"{age / 3600:.1f}" if age is not None else ''
+        ])
+    headers = STATS_FIELDS[:6] + ['core_hours', 'oldest_hours']
+    echo.echo(tabulate(table, headers=headers))
+
+
+@fw_cli.command("recover-lost-jobs")
+@click.option('--fizzle',
+              is_flag=True,
+              default=False,
+              help='Leave the jobs FIZZLED instead of running them again.')
+@click.option('--computer-id',
+              type=str,
+              help='Only recover the jobs of the computer with this host name.')
+@click.option('--launchpad-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help='LaunchPad file to use instead of the default one.')
+def recover_lost_jobs(fizzle, computer_id, launchpad_file):
+    """
+    Recover the AiiDA jobs whose lease has expired.
+
+    This can be run periodically (e.g. with cron) instead of setting
+    ``recover_lost_jobs`` for the computers.
+    """
+    from aiida_fireworks_scheduler.launchpads import get_launchpad
+    from aiida_fireworks_scheduler import maintenance
+
+    fw_ids = maintenance.recover_lost_jobs(get_launchpad(launchpad_file),
+                                           rerun=not fizzle,
+                                           computer_id=computer_id)
+    echo.echo_success(f"Recovered {len(fw_ids)} jobs: {fw_ids}")
+
+
+@fw_cli.command("release")
+@click.argument('fw_ids', type=int, nargs=-1)
+@click.option('--computer-id',
+              type=str,
+              help='Only release the jobs of the computer with this host name.')
+@click.option('--all',
+              'release_all',
+              is_flag=True,
+              default=False,
+              help='Release all the held jobs if no FW_IDS are given.')
+@click.option('--launchpad-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help='LaunchPad file to use instead of the default one.')
+def release(fw_ids, computer_id, release_all, launchpad_file):
+    """
+    Release the AiiDA jobs submitted as held, all at once.
+
+    The jobs to release are given by FW_IDS, or by --all optionally restricted
+    to the jobs of a computer with --computer-id.
+    """
+    from aiida_fireworks_scheduler.launchpads import get_launchpad
+    from aiida_fireworks_scheduler.hold import release_jobs
+
+    if not fw_ids and not release_all:
+        echo.echo_critical("Pass the ids of the jobs to release, or --all.")
+        return
+    released = release_jobs(get_launchpad(launchpad_file),
+                            fw_ids=fw_ids or None,
+                            computer_id=computer_id)
+    echo.echo_success(f"Released {len(released)} jobs.")
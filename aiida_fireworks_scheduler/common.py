@@ -1,6 +1,51 @@
 """
 Module for common stuff like global variables...
 """
+from datetime import datetime
 
 DEFAULT_USERNAME = "AIIDA_USER"
 RESERVED_CATEGORY = "AIIDA_RESERVED_CATEGORY"
+
+# Entry points of the schedulers provided by this plugin
+FW_SCHEDULER_TYPES = [
+    "fireworks", "fireworks_scheduler.default", "fireworks_scheduler.keepenv"
+]
+# Name of the Computer property holding the settings of the fireworks scheduler
+SETTINGS_PROPERTY = "fireworks_scheduler"
+
+# States of the Fireworks that are still visible to AiiDA as jobs in the queue.
+# Listed explicitly (rather than excluding COMPLETED and ARCHIVED) so that queries
+# can be served by an index
+ACTIVE_STATES = [
+    'WAITING', 'READY', 'RESERVED', 'RUNNING', 'PAUSED', 'FIZZLED', 'DEFUSED'
+]
+
+# Format of the times stored by Fireworks, e.g. ``created_on`` and ``time_start``
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def match_any(value):
+    """Query condition matching a value, or any of a list of values"""
+    if isinstance(value, (list, tuple)):
+        if len(value) == 1:
+            return value[0]
+        return {'$in': list(value)}
+    return value
+
+
+def parse_time(value):
+    """
+    Parse a time stored by Fireworks
+
+    The times are stored as strings in the ISO format, without the microseconds if
+    they are zero, but may also be datetime objects.
+
+    :param value: The stored time, or None
+    :returns: A datetime object, or None if no time is given
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value, ISO_FORMAT)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
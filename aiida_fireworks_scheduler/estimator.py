@@ -0,0 +1,132 @@
+"""
+Estimating the actual runtime of the AiiDA jobs from their history
+
+The walltime requested by AiiDA jobs (``max_wallclock_seconds``) is often generous.
+The estimator learns the ratio between the actual runtime and the requested
+walltime from the recently completed jobs of the same computer and user. A worker
+with an estimator selects the jobs by their predicted runtime, while the requested
+walltime is still used as the hard limit for running them.
+"""
+import time
+
+from aiida_fireworks_scheduler.common import RESERVED_CATEGORY, match_any
+from aiida_fireworks_scheduler.launchpads import LaunchPadClient
+
+
+class WalltimeEstimator(LaunchPadClient):
+    """Estimator for the fraction of the requested walltime actually used by the jobs"""
+    def __init__(self,
+                 computer_id,
+                 username,
+                 launchpad=None,
+                 quantile=0.95,
+                 margin=1.2,
+                 min_ratio=0.1,
+                 min_samples=20,
+                 window=200,
+                 refresh=600):
+        """
+        Instantiate a WalltimeEstimator
+
+        :param computer_id: The computer (or a list of computers) of the jobs to learn
+          from.
+        :param username: The user (or a list of users) of the jobs to learn from.
+        :param launchpad: The LaunchPad to query, may be set later.
+        :param quantile: Quantile of the ratios between the runtime and the requested
+          walltime to use for the prediction.
+        :param margin: Safety factor applied to the ratio.
+        :param min_ratio: Lower limit of the ratio.
+        :param min_samples: Minimum number of completed jobs needed for an estimate.
+        :param window: Number of the most recently completed jobs to learn from.
+        :param refresh: Seconds before the ratio is recomputed.
+        """
+        self.computer_id = computer_id
+        self.username = username
+        self.quantile = quantile
+        self.margin = margin
+        self.min_ratio = min_ratio
+        self.min_samples = min_samples
+        self.window = window
+        self.refresh = refresh
+        self._ratio = 1.0
+        self._updated = None
+        if launchpad is not None:
+            self.launchpad = launchpad
+
+    def get_samples(self):
+        """
+        Get the ratios between the runtime and the requested walltime of the recently
+        completed jobs
+        """
+        fw_docs = self.launchpad.fireworks.find(
+            {
+                'spec._category': RESERVED_CATEGORY,
+                'spec._aiida_job_info.computer_id': match_any(self.computer_id),
+                'spec._aiida_job_info.username': match_any(self.username),
+                'state': 'COMPLETED',
+            }, {
+                'fw_id': 1,
+                'spec._aiida_job_info.walltime': 1
+            },
+            sort=[('fw_id', -1)],
+            limit=self.window)
+        walltimes = {
+            doc['fw_id']: doc['spec']['_aiida_job_info']['walltime']
+            for doc in fw_docs
+        }
+        if not walltimes:
+            return []
+
+        runtimes = {}
+        for doc in self.launchpad.launches.find(
+            {
+                'fw_id': {
+                    '$in': list(walltimes)
+                },
+                'state': 'COMPLETED'
+            }, {
+                'fw_id': 1,
+                'runtime_secs': 1
+            },
+                sort=[('launch_id', 1)]):
+            # The last launch of each firework is used
+            if doc.get('runtime_secs') is not None:
+                runtimes[doc['fw_id']] = doc['runtime_secs']
+        return [
+            runtimes[fw_id] / walltime
+            for fw_id, walltime in walltimes.items()
+            if fw_id in runtimes and walltime
+        ]
+
+    def compute_ratio(self):
+        """
+        Compute the fraction of the requested walltime expected to be used, which
+        is 1 if there are not enough completed jobs.
+        """
+        samples = sorted(self.get_samples())
+        if len(samples) < self.min_samples:
+            return 1.0
+        value = samples[int(round(self.quantile * (len(samples) - 1)))]
+        return min(1.0, max(self.min_ratio, value * self.margin))
+
+    @property
+    def ratio(self):
+        """The cached fraction of the requested walltime expected to be used"""
+        if self.launchpad is None:
+            return 1.0
+        if self._updated is None or time.time(
+        ) - self._updated > self.refresh:
+            self._ratio = self.compute_ratio()
+            self._updated = time.time()
+        return self._ratio
+
+    def to_dict(self):
+        """Settings of the estimator"""
+        return {
+            'quantile': self.quantile,
+            'margin': self.margin,
+            'min_ratio': self.min_ratio,
+            'min_samples': self.min_samples,
+            'window': self.window,
+            'refresh': self.refresh,
+        }
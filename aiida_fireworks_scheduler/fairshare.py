@@ -0,0 +1,117 @@
+"""
+Fair share of the workers between the users sharing a LaunchPad
+
+A worker running the AiiDA jobs of several users checks out the jobs of the user
+with the least recent usage first. The usage is the number of core-seconds of the
+AiiDA jobs of each user on the computer, running or finished within a time window,
+computed from the launches and cached.
+"""
+from datetime import datetime, timedelta
+import time
+
+from aiida_fireworks_scheduler.common import RESERVED_CATEGORY, match_any, parse_time
+from aiida_fireworks_scheduler.launchpads import LaunchPadClient
+
+
+class FairShare(LaunchPadClient):
+    """Ordering of the users by their recent usage of a computer"""
+    def __init__(self,
+                 computer_id,
+                 usernames,
+                 launchpad=None,
+                 window=86400,
+                 refresh=300):
+        """
+        Instantiate a FairShare
+
+        :param computer_id: The computer (or a list of computers) of the jobs.
+        :param usernames: A list of the users sharing the worker.
+        :param launchpad: The LaunchPad to query, may be set later.
+        :param window: Seconds of history to account for.
+        :param refresh: Seconds before the usage is recomputed.
+        """
+        self.computer_id = computer_id
+        self.usernames = list(usernames)
+        self.window = window
+        self.refresh = refresh
+        self._order = list(self.usernames)
+        self._updated = None
+        if launchpad is not None:
+            self.launchpad = launchpad
+
+    def get_usage(self, now=None):
+        """
+        Compute the core-seconds used by each user within the time window
+
+        :param now: Current time (UTC), for testing.
+        :returns: A dictionary of the usage of each user.
+        """
+        now = now or datetime.utcnow()
+        start = now - timedelta(seconds=self.window)
+        usage = {username: 0.0 for username in self.usernames}
+
+        launches = list(
+            self.launchpad.launches.find(
+                {
+                    '$or': [{
+                        'state': 'RUNNING'
+                    }, {
+                        'time_end': {
+                            '$gte': start.isoformat()
+                        }
+                    }]
+                }, {
+                    'fw_id': 1,
+                    'time_start': 1,
+                    'time_end': 1,
+                    '_id': 0
+                }))
+        if not launches:
+            return usage
+
+        jobs = {
+            doc['fw_id']: doc['spec']['_aiida_job_info']
+            for doc in self.launchpad.fireworks.find(
+                {
+                    'fw_id': {
+                        '$in': list({launch['fw_id']
+                                     for launch in launches})
+                    },
+                    'spec._category': RESERVED_CATEGORY,
+                    'spec._aiida_job_info.computer_id':
+                    match_any(self.computer_id),
+                    'spec._aiida_job_info.username': {
+                        '$in': self.usernames
+                    },
+                }, {
+                    'fw_id': 1,
+                    'spec._aiida_job_info.username': 1,
+                    'spec._aiida_job_info.mpinp': 1,
+                })
+        }
+        for launch in launches:
+            info = jobs.get(launch['fw_id'])
+            time_start = parse_time(launch.get('time_start'))
+            if info is None or time_start is None:
+                continue
+            time_end = parse_time(launch.get('time_end')) or now
+            seconds = (time_end - max(time_start, start)).total_seconds()
+            usage[info['username']] += max(seconds, 0) * max(
+                info.get('mpinp', 1), 1)
+        return usage
+
+    @property
+    def usernames_in_order(self):
+        """The users, with the least recent usage first"""
+        if self.launchpad is None:
+            return self._order
+        if self._updated is None or time.time(
+        ) - self._updated > self.refresh:
+            usage = self.get_usage()
+            self._order = sorted(self.usernames, key=lambda name: usage[name])
+            self._updated = time.time()
+        return self._order
+
+    def to_dict(self):
+        """Settings of the fair share"""
+        return {'window': self.window, 'refresh': self.refresh}
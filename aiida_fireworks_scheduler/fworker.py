@@ -4,7 +4,9 @@ include multiprocessing (mpinp) and walltime limit in the query
 """
 
 import json
+import os
 import six
+from pymongo import DESCENDING
 
 from fireworks.core.fworker import FWorker
 from fireworks.utilities.fw_serializers import recursive_serialize, \
@@ -12,7 +14,12 @@ from fireworks.utilities.fw_serializers import recursive_serialize, \
 
 from aiida_fireworks_scheduler.awareness import SchedulerAwareness
 
-from aiida_fireworks_scheduler.common import DEFAULT_USERNAME, RESERVED_CATEGORY
+from aiida_fireworks_scheduler.common import DEFAULT_USERNAME, RESERVED_CATEGORY, \
+    match_any
+from aiida_fireworks_scheduler.usage import INTERVAL_ENV
+from aiida_fireworks_scheduler.estimator import WalltimeEstimator
+from aiida_fireworks_scheduler.fairshare import FairShare
+from aiida_fireworks_scheduler.launchpads import QuerySequence
 
 
 class AiiDAFWorker(FWorker):
@@ -20,12 +27,24 @@ class AiiDAFWorker(FWorker):
     Specialised worker for running AiiDA related jobs
     """
     SECONDS_SAFE_INTERVAL = 60
+    CHECKOUT_ORDERS = ('aiida', 'fireworks')
+    # Seconds the walltime limit of the query is rounded down to
+    QUERY_BUCKET = 60
 
     def __init__(self,
                  computer_id,
                  mpinp,
                  *args,
                  username=DEFAULT_USERNAME,
+                 stage_dir=None,
+                 cache_login_env=False,
+                 usage_interval=None,
+                 walltime_estimator=None,
+                 fair_share=None,
+                 min_mpinp=None,
+                 max_mpinp=None,
+                 computers=None,
+                 checkout_order='aiida',
                  **kwargs):
         """
         Instantiate a AiiDAFWorker object.
@@ -33,42 +52,211 @@ class AiiDAFWorker(FWorker):
         constructor
 
         :param computer_id: Hostname of the computer
-        :param username: User name for the computer
+        :param username: User name for the computer, or a list of them to run the jobs
+          of several users
         :param mpinp: the number of MPI processes to be launched.
           this constraint will be ignored if is is set to -1 or 0.
+        :param min_mpinp: Run jobs with at least this number of MPI processes,
+          up to ``max_mpinp`` or ``mpinp``, preferring the largest jobs.
+        :param max_mpinp: Run jobs with at most this number of MPI processes,
+          preferring the largest jobs.
+        :param computers: A list of (computer_id, username) pairs of other computers
+          to run the jobs of, e.g. aliases of the same cluster.
+        :param stage_dir: Folder on the compute node (e.g. ``$TMPDIR``) to copy the
+          working directory of the AiiDA jobs to for running them.
+        :param cache_login_env: Capture the login environment once per allocation
+          and reuse it for the jobs that run in a fresh environment.
+        :param usage_interval: Sample the resource usage of the jobs at this interval
+          in seconds, and attach a summary to their launches.
+        :param walltime_estimator: Settings of a ``WalltimeEstimator`` (or True for
+          the defaults) to select the AiiDA jobs by their predicted runtime rather
+          than the requested walltime.
+        :param fair_share: Settings of a ``FairShare`` (or True for the defaults) to
+          run the jobs of the user with the least recent usage first, if there are
+          several users.
+        :param checkout_order: Which of the AiiDA jobs ('aiida') and the other
+          Fireworks ('fireworks') are tried first.
 
         The rest of the arguments will be passed to the FWorker.
         """
         self.computer_id = computer_id
         self.username = username
+        self.computers = [tuple(pair) for pair in computers or []]
         self.sch_aware = SchedulerAwareness.get_awareness()
         self.mpinp = mpinp
+        self.min_mpinp = min_mpinp
+        self.max_mpinp = max_mpinp
+        self.stage_dir = stage_dir
+        self.cache_login_env = cache_login_env
+        self.usage_interval = usage_interval
+        if checkout_order not in self.CHECKOUT_ORDERS:
+            raise ValueError(f'Unknown checkout order: {checkout_order}')
+        self.checkout_order = checkout_order
+        if walltime_estimator is True:
+            walltime_estimator = {}
+        if isinstance(walltime_estimator, dict):
+            self.estimator = WalltimeEstimator(self.computer_ids,
+                                               self.usernames,
+                                               **walltime_estimator)
+        else:
+            self.estimator = None
+        if fair_share is True:
+            fair_share = {}
+        if isinstance(fair_share, dict) and len(self.usernames) > 1:
+            self.fair_share = FairShare(self.computer_ids, self.usernames,
+                                        **fair_share)
+        else:
+            self.fair_share = None
         super().__init__(*args, **kwargs)
 
+        # Static parts of the query
+        self._fireworks_template = self.get_fireworks_query()
+        self._aiida_template, self._aiida_sort = self.get_aiida_query()
+        self._job_condition = self.get_job_condition()
+        self._user_conditions = {
+            username: self.get_job_condition(username)
+            for username in self.usernames
+        }
+        self._compiled_query = None
+
+    @property
+    def job_pairs(self):
+        """The (computer_id, username) pairs of the jobs to run"""
+        usernames = self.username if isinstance(self.username,
+                                                (list, tuple)) else [self.username]
+        pairs = [(self.computer_id, username) for username in usernames]
+        return pairs + [pair for pair in self.computers if pair not in pairs]
+
+    @property
+    def computer_ids(self):
+        """The computers of the jobs to run"""
+        return list(dict.fromkeys(pair[0] for pair in self.job_pairs))
+
+    @property
+    def usernames(self):
+        """The users of the jobs to run"""
+        return list(dict.fromkeys(pair[1] for pair in self.job_pairs))
+
+    def get_job_condition(self, username=None):
+        """
+        Condition matching the computers and users of the AiiDA jobs to run
+
+        :param username: Only match the jobs of this user, if given.
+        """
+        # Users of the same computers are matched together, so that a single
+        # condition is used in the usual case
+        groups = {}
+        for computer_id, name in self.job_pairs:
+            if username is None or name == username:
+                groups.setdefault(computer_id, []).append(name)
+        merged = {}
+        for computer_id, names in groups.items():
+            merged.setdefault(tuple(names), []).append(computer_id)
+        conditions = [{
+            'spec._aiida_job_info.computer_id': match_any(computer_ids),
+            'spec._aiida_job_info.username': match_any(names)
+        } for names, computer_ids in merged.items()]
+        if len(conditions) == 1:
+            return conditions[0]
+        return {'$or': conditions}
+
+    def attach_launchpad(self, launchpad):
+        """Attach the LaunchPad used for querying the history of the jobs"""
+        for client in (self.estimator, self.fair_share):
+            if client is not None:
+                client.launchpad = launchpad
+
+    def get_runtime_env(self, private_dir=None):
+        """
+        Environment variables to be set by the launcher, which control how the
+        AiiDA jobs are run.
+
+        :param private_dir: Directory only accessible by the launcher, e.g. made by
+          `tempfile.mkdtemp`, holding the cache of the login environment if
+          ``cache_login_env`` is set. The login environment is not cached without it.
+        """
+        env = {}
+        if self.stage_dir:
+            env['AIIDA_FW_STAGE_DIR'] = os.path.expandvars(self.stage_dir)
+        if self.cache_login_env and private_dir:
+            env['AIIDA_FW_ENV_CACHE'] = os.path.join(private_dir, 'login-env')
+        if self.usage_interval:
+            env[INTERVAL_ENV] = str(self.usage_interval)
+        return env
+
     @property
     def query(self):
-        """Query used for selecting fireworks"""
+        """
+        Query used for selecting fireworks
 
-        # This is the usual conventional stuff
-        query_ = dict(self._query)
-        fworker_check = [{
-            "spec._fworker": {
-                "$exists": False
-            }
-        }, {
-            "spec._fworker": None
-        }, {
-            "spec._fworker": self.name
-        }]
-        if '$or' in query_:
-            query_['$and'] = query_.get('$and', [])
-            query_['$and'].extend([{
-                '$or': query_.pop('$or')
-            }, {
-                '$or': fworker_check
-            }])
+        The AiiDA jobs and the other Fireworks are selected by separate queries, tried
+        in the order given by ``checkout_order``, so that each of them can be served
+        by a single compound index.
+
+        The static parts of the queries are built when the worker is created. The
+        walltime limit is rounded down to ``QUERY_BUCKET`` seconds, and the same
+        object is returned until it (or the ratio of the estimator, or the order of
+        the users with fair share) changes, so it should not be modified.
+        """
+        walltime_limit = self.seconds_left - self.SECONDS_SAFE_INTERVAL
+        walltime_limit -= walltime_limit % self.QUERY_BUCKET
+        ratio = self.estimator.ratio if self.estimator is not None else 1.0
+        usernames = tuple(self.fair_share.usernames_in_order
+                          ) if self.fair_share is not None else None
+
+        key = (walltime_limit, ratio, usernames)
+        compiled = self._compiled_query
+        if compiled is None or compiled[0] != key:
+            compiled = (key,
+                        self._compile_query(walltime_limit, ratio, usernames))
+            self._compiled_query = compiled
+        return compiled[1]
+
+    def _compile_query(self, walltime_limit, ratio, usernames):
+        """
+        Fill in the query templates with the walltime limit
+
+        :param walltime_limit: Seconds left for running the jobs.
+        :param ratio: Fraction of the requested walltime the AiiDA jobs are expected
+          to use.
+        :param usernames: The users in the order their jobs are tried with fair
+          share, or None.
+        """
+        query_fw = dict(self._fireworks_template)
+        # Either not having a walltime limit or have a one that is less than the
+        # current limit
+        query_fw['spec._walltime_seconds'] = {'$not': {'$gte': walltime_limit}}
+
+        # AiiDA related queries - the jobs are selected by their predicted runtime
+        # if an estimator is used
+        query_aiida = dict(self._aiida_template)
+        query_aiida['spec._aiida_job_info.walltime'] = {
+            '$lt': walltime_limit / ratio
+        }
+        # With fair share, the jobs of each user are tried in turn before the others
+        if usernames is not None:
+            queries = [
+                dict(query_aiida, **self._user_conditions[username])
+                for username in usernames
+            ]
         else:
-            query_['$or'] = fworker_check
+            queries = [dict(query_aiida, **self._job_condition)]
+        sorts = [self._aiida_sort] * len(queries)
+
+        if self.checkout_order == 'fireworks':
+            return QuerySequence([query_fw] + queries, [None] + sorts)
+        return QuerySequence(queries + [query_fw], sorts + [None])
+
+    def get_fireworks_query(self):
+        """
+        Query for the standard (non-AiiDA) Fireworks to run, without the condition on
+        their walltime
+        """
+        # This is the usual conventional stuff, with the conditions on a single field
+        # each rather than nested under $or, so that an index can be used
+        query_ = dict(self._query)
+        # Missing fields are matched by None
+        query_['spec._fworker'] = {'$in': [None, self.name]}
         if self.category and isinstance(self.category, six.string_types):
             if self.category == "__none__":
                 query_['spec._category'] = {"$exists": False}
@@ -82,36 +270,39 @@ class AiiDAFWorker(FWorker):
         # Do not match any AIIDA_RESERVED_CATEGORY jobs - those jobs should be matched by
         # specific conditions as defined below
         query_['spec._category']['$ne'] = RESERVED_CATEGORY
+        return query_
 
-        # Either not having a walltime limit or have a one that is less than the
-        # current limit
-        walltime_condition = {
-            '$or': [{
-                'spec._walltime_seconds': {
-                    '$exists': False
-                }
-            }, {
-                'spec._walltime_seconds': {
-                    '$lt': self.seconds_left - self.SECONDS_SAFE_INTERVAL
-                }
-            }]
-        }
-        # Combined query for the standard fireworks jobs
-        query_fw = {'$and': [query_, walltime_condition]}
-
-        # AiiDA related queries
-        query_aiida = {
-            'spec._aiida_job_info.computer_id': self.computer_id,
-            'spec._aiida_job_info.username': self.username,
-            'spec._aiida_job_info.walltime': {
-                '$lt': self.seconds_left - self.SECONDS_SAFE_INTERVAL
-            }
-        }
-        if self.mpinp > 0:
+    def get_aiida_query(self):
+        """
+        Query for the AiiDA jobs to run, without the conditions on their computers,
+        users and walltime
+
+        :returns: The query and its sort keys.
+        """
+        query_aiida = {'spec._category': RESERVED_CATEGORY}
+        sort = None
+        mpinp_range = self.mpinp_range
+        if mpinp_range:
+            query_aiida['spec._aiida_job_info.mpinp'] = mpinp_range
+            # The largest jobs that fit are preferred
+            sort = [('spec._aiida_job_info.mpinp', DESCENDING)]
+        elif self.mpinp > 0:
             query_aiida['spec._aiida_job_info.mpinp'] = self.mpinp
+        return query_aiida, sort
 
-        # Need to satisfy either of the two sub queries
-        return {'$or': [query_aiida, query_fw]}
+    @property
+    def mpinp_range(self):
+        """
+        Condition for the number of MPI processes of the jobs if a range is used,
+        otherwise None
+        """
+        if self.min_mpinp is None and self.max_mpinp is None:
+            return None
+        condition = {'$gte': self.min_mpinp or 1}
+        upper = self.max_mpinp or (self.mpinp if self.mpinp > 0 else None)
+        if upper:
+            condition['$lte'] = upper
+        return condition
 
     @property
     def seconds_left(self):
@@ -129,7 +320,18 @@ class AiiDAFWorker(FWorker):
             'env': self.env,
             'computer_id': self.computer_id,
             'username': self.username,
+            'computers': [list(pair) for pair in self.computers],
+            'checkout_order': self.checkout_order,
             'mpinp': self.mpinp,
+            'min_mpinp': self.min_mpinp,
+            'max_mpinp': self.max_mpinp,
+            'stage_dir': self.stage_dir,
+            'cache_login_env': self.cache_login_env,
+            'usage_interval': self.usage_interval,
+            'walltime_estimator':
+            self.estimator.to_dict() if self.estimator else None,
+            'fair_share':
+            self.fair_share.to_dict() if self.fair_share else None,
         }
 
     @classmethod
@@ -138,6 +340,18 @@ class AiiDAFWorker(FWorker):
         return AiiDAFWorker(computer_id=m_dict['computer_id'],
                             username=m_dict.get('username', DEFAULT_USERNAME),
                             mpinp=m_dict['mpinp'],
+                            min_mpinp=m_dict.get('min_mpinp'),
+                            max_mpinp=m_dict.get('max_mpinp'),
+                            computers=m_dict.get('computers'),
+                            checkout_order=m_dict.get(
+                                'checkout_order', 'aiida'),
+                            stage_dir=m_dict.get('stage_dir'),
+                            cache_login_env=m_dict.get(
+                                'cache_login_env', False),
+                            usage_interval=m_dict.get('usage_interval'),
+                            walltime_estimator=m_dict.get(
+                                'walltime_estimator'),
+                            fair_share=m_dict.get('fair_share'),
                             name=m_dict['name'],
                             category=m_dict['category'],
                             query=json.loads(m_dict['query']),
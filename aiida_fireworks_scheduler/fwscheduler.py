@@ -2,13 +2,18 @@
 Specialised scheduler to interface with Fireworks
 """
 
-from datetime import datetime
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import functools
+import json
 import os
+import threading
+import time
 
-from fireworks.core.launchpad import LaunchPad
-from fireworks.fw_config import LAUNCHPAD_LOC
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
 import aiida.schedulers
+from aiida import orm
 from aiida.common.exceptions import FeatureNotAvailable
 from aiida.common.folders import SandboxFolder
 from aiida.common.extendeddicts import AttributeDict
@@ -19,7 +24,20 @@ from aiida.schedulers.datastructures import (JobInfo, JobState,
                                              ParEnvJobResource)
 
 from aiida_fireworks_scheduler.jobs import AiiDAJobFirework
-from aiida_fireworks_scheduler.common import DEFAULT_USERNAME
+from aiida_fireworks_scheduler.common import (DEFAULT_USERNAME, ACTIVE_STATES,
+                                              FW_SCHEDULER_TYPES,
+                                              RESERVED_CATEGORY,
+                                              SETTINGS_PROPERTY, parse_time)
+from aiida_fireworks_scheduler.launchpads import (ensure_indexes,
+                                                  get_launchpad, get_executor,
+                                                  get_read_collection,
+                                                  DEFAULT_MAX_POOL_SIZE)
+from aiida_fireworks_scheduler.maintenance import (age_priorities,
+                                                   recover_lost_jobs,
+                                                   requeue_timed_out_jobs,
+                                                   LOST_FIELD)
+from aiida_fireworks_scheduler.grouping import add_grouped_firework
+from aiida_fireworks_scheduler.hold import add_workflow, hold_firework
 
 # pylint: disable=protected-access,too-many-locals
 
@@ -37,6 +55,22 @@ _MAP_STATUS_FW = {
     'FIZZLED': JobState.UNDETERMINED
 }
 
+# Time of the last maintenance run for each LaunchPad and computer
+_LAST_MAINTENANCE = {}
+
+# States of the jobs counted against the ``max_queued`` limit of a computer
+QUEUED_STATES = ['WAITING', 'READY']
+# Seconds before the cached number of queued jobs is counted again
+QUEUED_REFRESH = 30
+# Cached number of queued jobs for each LaunchPad and computer, as (time, count)
+_QUEUED_COUNTS = {}
+_QUEUED_LOCK = threading.Lock()
+# Default seconds to wait for the LaunchPad before the operation is retried by AiiDA
+LAUNCHPAD_TIMEOUT = 10
+# Calls to the LaunchPad still running after their timeout, for each thread pool
+_STUCK_CALLS = {}
+_STUCK_LOCK = threading.Lock()
+
 
 class FwJobResource(ParEnvJobResource):
     """
@@ -84,64 +118,117 @@ class FwScheduler(Scheduler):
     }
 
     _job_resource_class = FwJobResource
-    _lpad = None
     FRESH_ENV = True
 
     def __init__(self, launchpad=None):
+        """
+        Instantiate the scheduler
+
+        :param launchpad: The `LaunchPad` to use. If not given, the shared `LaunchPad`
+          for the location set in the settings of the Computer (or the default one of
+          fireworks) is used.
+        """
         super().__init__()
-        # Here store the launchpad in the class attribute so it can be reused....
         if launchpad is not None:
-            self.lpad = launchpad
-            # Keep the launchpad
-            FwScheduler._lpad = launchpad
-        else:
-            # Create and save the launchpad
-            if FwScheduler._lpad is None:
-                FwScheduler._lpad = LaunchPad.from_file(LAUNCHPAD_LOC)
-            self.lpad = FwScheduler._lpad
+            ensure_indexes(launchpad)
+        self._lpad = launchpad
+        self._settings = None
+
+    @property
+    def settings(self):
+        """
+        Settings of the scheduler stored in the Computer, see `get_computer_settings`.
+        Empty before the transport is set.
+        """
+        if self._transport is None:
+            return {}
+        if self._settings is None:
+            self._settings = get_computer_settings(self.transport._machine)
+        return self._settings
+
+    @property
+    def lpad(self):
+        """The `LaunchPad` that the jobs are submitted to"""
+        if self._lpad is None:
+            self._lpad = get_launchpad(
+                self.settings.get('launchpad'),
+                max_pool_size=self.settings.get('max_pool_size',
+                                                DEFAULT_MAX_POOL_SIZE))
+        return self._lpad
 
     def get_jobs(self, jobs=None, user=None, as_dict=False):
         """
         Return the list of currently active jobs
         """
-        computer_id = self.transport._machine  # Host name is used as the identifier
+        joblist = self._run_blocking(self._query_jobs,
+                                     self.transport._machine, jobs)
+        if as_dict:
+            return _as_jobdict(joblist)
+        return joblist
+
+    def _query_jobs(self, computer_id, jobs=None):
+        """
+        Query the LaunchPad for the active jobs of a computer
+
+        :param computer_id: Host name of the computer, used as the identifier
+        :param jobs: Only include the jobs with these ids, if given.
+        :returns: A list of `JobInfo`
+        """
         lpad = self.lpad
+        self._run_maintenance(computer_id)
 
         query = {
             "spec._aiida_job_info.computer_id":
             computer_id,  # Limit to this machine
-            # Ignore completed and archived jobs
+            # Only include jobs that are not completed or archived
             "state": {
-                "$not": {
-                    "$in": ["COMPLETED", "ARCHIVED"]
-                }
+                "$in": ACTIVE_STATES
             }
         }
 
-        # Limit to the specific fw_ids
+        # Limit to the specific fw_ids - this is served by the unique index of fw_id,
+        # jobs that have finished are simply not returned
         if jobs:
             # Convert to integer keys
             jobs = [int(job_id) for job_id in jobs]
             query['fw_id'] = {'$in': jobs}
 
-        fw_ids = lpad.get_fw_ids(query)
-        joblist = []
-        for fid in fw_ids:
-            # Get the information of the fireworks in the dict format
-            # this is more robust than getting Fireworks objects
-            try:
-                fw_dict = lpad.get_fw_dict_by_id(fid)
-            except ValueError:
-                raise SchedulerError(f"No FW found for id: {fid}")
+        # Fetch only the fields needed in a single query
+        projection = {
+            'fw_id': True,
+            'state': True,
+            LOST_FIELD: True,
+            'name': True,
+            'created_on': True,
+            'spec.category': True,
+            '_id': False
+        }
+        read_preference = self.settings.get('read_preference')
+        fireworks = get_read_collection(lpad, 'fireworks', read_preference,
+                                        self.settings.get('max_staleness', -1))
+        fw_dicts = list(fireworks.find(query, projection))
+
+        # A secondary may not have the jobs that have just been submitted, and AiiDA
+        # would take missing jobs as finished - check them on the primary
+        if jobs and read_preference not in (None, 'primary'):
+            missing = set(jobs).difference(fw_dict['fw_id']
+                                           for fw_dict in fw_dicts)
+            if missing:
+                query['fw_id'] = {'$in': list(missing)}
+                fw_dicts.extend(lpad.fireworks.find(query, projection))
 
+        joblist = []
+        for fw_dict in fw_dicts:
+            fid = fw_dict['fw_id']
             spec = fw_dict.get("spec", {})
 
             this_job = JobInfo()
             this_job.job_id = str(fid)
-            try:
-                this_job.job_state = _MAP_STATUS_FW[fw_dict['state']]
-            except IndexError:
-                this_job.job_state = JobState.UNDETERMINED
+            this_job.job_state = _MAP_STATUS_FW.get(fw_dict['state'],
+                                                    JobState.UNDETERMINED)
+            # Lost jobs not run again are finished, and fail in parse_output
+            if fw_dict.get(LOST_FIELD):
+                this_job.job_state = JobState.DONE
 
             this_job.title = fw_dict.get('name')
 
@@ -154,22 +241,67 @@ class FwScheduler(Scheduler):
 
             # The created_on is mapped to the submission time
             try:
-                this_job.submission_time = datetime.strptime(
-                    fw_dict['created_on'], "%Y-%m-%dT%H:%M:%S.%f")
+                this_job.submission_time = parse_time(fw_dict['created_on'])
             except ValueError:
                 pass
             # NOTE: add information about the dispatch time by looking into the launches
 
             joblist.append(this_job)
 
-        if as_dict:
-            jobdict = {job.job_id: job for job in joblist}
-            if None in jobdict:
-                raise SchedulerError('Found at least one job without jobid')
-            return jobdict
-
         return joblist
 
+    def _run_maintenance(self, computer_id):
+        """
+        Run the periodic maintenance enabled in the settings for the jobs of a
+        computer, at most once per minute
+
+        The jobs killed at their walltime are always requeued, as they were submitted
+        with ``max_requeues`` and would not be seen as finished otherwise, even if the
+        setting has been removed since.
+        """
+        interval = self.settings.get('aging_interval')
+        recover = self.settings.get('recover_lost_jobs')
+        key = (id(self.lpad), computer_id)
+        now = time.time()
+        if now - _LAST_MAINTENANCE.get(key, 0) < max(60, (interval or 0) / 10):
+            return
+        _LAST_MAINTENANCE[key] = now
+        if interval:
+            try:
+                age_priorities(self.lpad,
+                               interval,
+                               increment=self.settings.get(
+                                   'aging_increment', 10),
+                               max_levels=self.settings.get(
+                                   'aging_max_levels', 10),
+                               computer_id=computer_id)
+            except PyMongoError as error:
+                self._logger.warning(f'Failed to age the priorities: {error}')
+        if recover:
+            try:
+                fw_ids = recover_lost_jobs(self.lpad,
+                                           rerun=recover == 'rerun',
+                                           computer_id=computer_id)
+            except PyMongoError as error:
+                self._logger.warning(f'Failed to recover lost jobs: {error}')
+            else:
+                if fw_ids:
+                    self._logger.warning(
+                        f'Recovered the lost jobs with expired leases: {fw_ids}'
+                    )
+        try:
+            fw_ids = requeue_timed_out_jobs(
+                self.lpad,
+                factor=self.settings.get('requeue_factor', 1.5),
+                computer_id=computer_id)
+        except PyMongoError as error:
+            self._logger.warning(
+                f'Failed to requeue the timed out jobs: {error}')
+        else:
+            if fw_ids:
+                self._logger.info(
+                    f'Requeued the jobs killed at their walltime: {fw_ids}')
+
     def submit_from_script(self, working_directory, submit_script):
         """Submit the submission script to the scheduler
 
@@ -177,7 +309,68 @@ class FwScheduler(Scheduler):
         directory and submit it to the LaunchPad.
 
         :return: return a string with the job ID in a valid format to be used for querying.
+        :raises SchedulerError: if the computer has more than ``max_queued`` jobs
+          waiting to run, so that the submission is retried later.
+        """
+        # A job submitted already is not counted against the limit
+        fw_id = self._run_blocking(self._check_submission, working_directory)
+        if fw_id is not None:
+            return str(fw_id)
+        firework = self._prepare_firework(working_directory, submit_script)
+        return self._run_blocking(self._add_firework, firework)
+
+    def _check_submission(self, working_directory):
+        """
+        Return the id of the Firework of the job if it has been added already,
+        otherwise check that the computer is below the ``max_queued`` limit.
+        """
+        fw_id = self._find_submitted({
+            'computer_id': self.transport._machine,
+            'remote_work_dir': working_directory
+        })
+        if fw_id is None:
+            self._check_queue()
+        return fw_id
+
+    def _check_queue(self):
         """
+        Raise a SchedulerError if the computer has ``max_queued`` jobs or more waiting
+        to run. The number of jobs is counted at most every ``QUEUED_REFRESH``
+        seconds, and the submissions made since are added to it.
+        """
+        max_queued = self.settings.get('max_queued')
+        if not max_queued:
+            return
+        computer_id = self.transport._machine
+        key = (id(self.lpad), computer_id)
+        now = time.time()
+        with _QUEUED_LOCK:
+            updated, count = _QUEUED_COUNTS.get(key, (0, 0))
+        if now - updated > QUEUED_REFRESH:
+            count = self.lpad.fireworks.count_documents({
+                'spec._aiida_job_info.computer_id': computer_id,
+                'state': {
+                    '$in': QUEUED_STATES
+                }
+            })
+            with _QUEUED_LOCK:
+                _QUEUED_COUNTS[key] = (now, count)
+        if count >= max_queued:
+            raise SchedulerError(
+                f'There are {count} jobs waiting to run on {computer_id}, '
+                f'reaching the limit of {max_queued}. The submission will be retried later.'
+            )
+
+    def _count_submission(self, computer_id):
+        """Add a submission to the cached number of queued jobs of a computer"""
+        key = (id(self.lpad), computer_id)
+        with _QUEUED_LOCK:
+            if key in _QUEUED_COUNTS:
+                updated, count = _QUEUED_COUNTS[key]
+                _QUEUED_COUNTS[key] = (updated, count + 1)
+
+    def _prepare_firework(self, working_directory, submit_script):
+        """Create the `AiiDAJobFirework` from the submission script on the remote computer"""
         self.transport.chdir(working_directory)
         with SandboxFolder() as sandbox:
             self.transport.getfile(submit_script,
@@ -202,11 +395,59 @@ class FwScheduler(Scheduler):
             stdout_fname=options['stdout_fname'],
             priority=options['priority'],
             fresh_env=self.FRESH_ENV,
+            stage_dir=self.settings.get('stage_dir'),
+            max_requeues=self.settings.get('max_requeues', 0),
         )
+        # Jobs submitted as held are kept PAUSED until released
+        if options['hold']:
+            hold_firework(firework)
+        return firework
+
+    def _add_firework(self, firework):
+        """
+        Add the Firework to the LaunchPad and return its id as a string.
 
-        mapping = self.lpad.add_wf(firework)
-        return str(list(mapping.values())
-                   [0])  # This is a string of the FW id assigned to the job
+        If the job has been added already, e.g. by a submission that was not recorded
+        by AiiDA, the id of the existing Firework is returned instead.
+        """
+        info = firework.spec['_aiida_job_info']
+        fw_id = self._find_submitted(info)
+        if fw_id is not None:
+            return str(fw_id)
+        window = self.settings.get('group_window')
+        try:
+            if window:
+                fw_id = add_grouped_firework(self.lpad,
+                                             firework,
+                                             window,
+                                             max_size=self.settings.get(
+                                                 'group_size', 100))
+            else:
+                mapping = add_workflow(self.lpad, firework)
+                fw_id = list(mapping.values())[0]
+        except (DuplicateKeyError, BulkWriteError):
+            # Added concurrently by another submission of the same job
+            fw_id = self._find_submitted(info)
+            if fw_id is None:
+                raise
+            return str(fw_id)
+        self._count_submission(info['computer_id'])
+        return str(fw_id)  # This is a string of the FW id assigned to the job
+
+    def _find_submitted(self, info):
+        """Return the id of the Firework of a job that has been added already, if any"""
+        fw_doc = self.lpad.fireworks.find_one(
+            {
+                'spec._category': RESERVED_CATEGORY,
+                'spec._aiida_job_info.computer_id': info['computer_id'],
+                'spec._aiida_job_info.remote_work_dir': info['remote_work_dir'],
+            }, {'fw_id': 1})
+        if fw_doc is None:
+            return None
+        self.logger.warning(
+            f"The job in {info['remote_work_dir']} has been submitted already "
+            f"as Firework {fw_doc['fw_id']}.")
+        return fw_doc['fw_id']
 
     def kill(self, jobid):
         """Defuse a job in the LaunchPad
@@ -214,47 +455,152 @@ class FwScheduler(Scheduler):
         Note, for fireworks this only works for queued jobs. Need to think about how to
         kill running ones....
         """
-        try:
-            fw_dict = self.lpad.get_fw_dict_by_id(int(jobid))
-        except Exception as error:  # pylint: disable=broad-except
-            self.logger.error(
-                f"Cannot find the relevant fireworks.\n Error {error.args}")
+        fw_dict = self._run_blocking(self._get_fw_dict, jobid)
+        if fw_dict is None:
             return False
 
         # If the job is running - request to stop the job by putting a AIIDA_STOP file
         # in the working directory
         if fw_dict['state'] == 'RUNNING':
-            try:
-                launch_dir = fw_dict['spec']['_aiida_job_info'][
-                    'remote_work_dir']
-                stop_file = os.path.join(launch_dir, 'AIIDA_STOP')
-                result = self.transport.exec_command_wait(f'touch {stop_file}')
-                if result[0] == 0:
-                    return True
-                self.logger.error(
-                    f"Remote command execution failed.\nSTDERR captured: {result[2]}"
-                )
-                return False
-            except Exception as error:  # pylint: disable=broad-except
-                self.logger.error(
-                    f"Error placing AIIDA_STOP file.\nError {error}")
-                return False
+            return self._place_stop_file(fw_dict)
         # Otherwise just defuse the job in the launchpad
-        else:
-            try:
-                firework = self.lpad.defuse_fw(int(jobid))
-            except Exception as error:  # pylint: disable=broad-except
-                self.logger.error(
-                    f"Error defusing waiting Firework.\nError {error}")
-                return False
-            else:
-                return bool(firework)
+        return self._run_blocking(self._defuse, jobid)
+
+    def _get_fw_dict(self, jobid):
+        """Return the Firework of a job as a dictionary, None if it cannot be found"""
+        try:
+            return self.lpad.get_fw_dict_by_id(int(jobid))
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.error(
+                f"Cannot find the relevant fireworks.\n Error {error.args}")
+            return None
+
+    def _place_stop_file(self, fw_dict):
+        """Request a running job to stop by placing an AIIDA_STOP file in its working directory"""
+        try:
+            launch_dir = fw_dict['spec']['_aiida_job_info']['remote_work_dir']
+            stop_file = os.path.join(launch_dir, 'AIIDA_STOP')
+            result = self.transport.exec_command_wait(f'touch {stop_file}')
+            if result[0] == 0:
+                return True
+            self.logger.error(
+                f"Remote command execution failed.\nSTDERR captured: {result[2]}"
+            )
+            return False
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.error(f"Error placing AIIDA_STOP file.\nError {error}")
+            return False
+
+    def _defuse(self, jobid):
+        """Defuse a job that is not running"""
+        try:
+            firework = self.lpad.defuse_fw(int(jobid))
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.error(
+                f"Error defusing waiting Firework.\nError {error}")
+            return False
+        return bool(firework)
+
+    def _run_blocking(self, func, *args):
+        """
+        Run a call to the LaunchPad, including connecting to it, in the thread pool
+        of its location, waiting for at most ``launchpad_timeout`` seconds.
+
+        AiiDA calls the scheduler from the event loop of the daemon, which is blocked
+        for the duration of the call. The timeout only bounds this blocking: if the
+        LaunchPad does not reply in time, a SchedulerError is raised for AiiDA to
+        retry the operation later, while the call carries on in the background. Until
+        it finishes, the calls for the same location fail at once rather than
+        blocking the daemon again. The settings are read from the AiiDA database
+        here, in the calling thread.
+
+        :raises SchedulerError: if the call does not finish in time, or earlier calls
+          that timed out are still running.
+        """
+        settings = self.settings
+        executor = get_executor(settings.get('launchpad'),
+                                max_workers=settings.get(
+                                    'max_pool_size', DEFAULT_MAX_POOL_SIZE))
+        timeout = settings.get('launchpad_timeout', LAUNCHPAD_TIMEOUT)
+        with _STUCK_LOCK:
+            nstuck = len(_STUCK_CALLS.get(executor, ()))
+        if nstuck:
+            raise SchedulerError(
+                f'{nstuck} earlier calls to the LaunchPad that timed out are still '
+                'running. The operation will be retried later.')
+        future = executor.submit(func, *args)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with _STUCK_LOCK:
+                _STUCK_CALLS.setdefault(executor, set()).add(future)
+            future.add_done_callback(
+                functools.partial(_forget_stuck_call, executor))
+            raise SchedulerError(
+                f'The LaunchPad did not reply within {timeout} seconds. '
+                'The operation will be retried later.')
 
     def get_detailed_job_info(self, job_id):
         """
-        Getting detailed job information. Does not make sense for this scheduler
+        Return the outcome of the last launch of a job recorded in the LaunchPad
+
+        The ``stdout`` holds the state of the Firework, the return code of the job
+        script and whether the job was killed at its walltime, as a JSON dictionary
+        read by `parse_output`.
         """
-        raise FeatureNotAvailable
+        return self._run_blocking(self._get_job_outcome, job_id)
+
+    def _get_job_outcome(self, job_id):
+        """Query the LaunchPad for the outcome of a job"""
+        lpad = self.lpad
+        fw_doc = lpad.fireworks.find_one({'fw_id': int(job_id)}, {
+            'state': 1,
+            'launches': 1,
+            LOST_FIELD: 1
+        })
+        if fw_doc is None:
+            return {
+                'retval': 1,
+                'stdout': '',
+                'stderr': f'Firework {job_id} does not exist'
+            }
+        launch = lpad.launches.find_one(
+            {'launch_id': {
+                '$in': fw_doc.get('launches', [])
+            }}, {'action.stored_data': 1},
+            sort=[('launch_id', DESCENDING)])
+        stored_data = ((launch or {}).get('action')
+                       or {}).get('stored_data') or {}
+        outcome = {
+            'state': fw_doc['state'],
+            'returncode': stored_data.get('returncode'),
+            'timeout': bool(stored_data.get('timeout')),
+            'lost': bool(fw_doc.get(LOST_FIELD)),
+        }
+        return {'retval': 0, 'stdout': json.dumps(outcome), 'stderr': ''}
+
+    def parse_output(self,
+                     detailed_job_info=None,
+                     stdout=None,
+                     stderr=None):
+        """
+        Return the exit code for a job killed at its walltime without being requeued,
+        or lost with its launcher and not run again, from the outcome given by
+        `get_detailed_job_info`. Such jobs are reported as finished, as AiiDA would
+        otherwise wait for them forever.
+        """
+        from aiida.engine import CalcJob  # pylint: disable=import-outside-toplevel
+        if not detailed_job_info or detailed_job_info.get('retval'):
+            return None
+        try:
+            outcome = json.loads(detailed_job_info['stdout'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if outcome.get('timeout'):
+            return CalcJob.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME
+        if outcome.get('lost'):
+            return CalcJob.exit_codes.ERROR_SCHEDULER_NODE_FAILURE
+        return None
 
     def _get_submit_script_header(self, job_tmpl):
         """
@@ -363,6 +709,47 @@ class FwScheduler(Scheduler):
         raise FeatureNotAvailable
 
 
+def _forget_stuck_call(executor, future):
+    """Stop counting a call that timed out once it has finished"""
+    with _STUCK_LOCK:
+        _STUCK_CALLS.get(executor, set()).discard(future)
+
+
+def _as_jobdict(joblist):
+    """Convert a list of `JobInfo` to a dictionary keyed by the job ids"""
+    jobdict = {job.job_id: job for job in joblist}
+    if None in jobdict:
+        raise SchedulerError('Found at least one job without jobid')
+    return jobdict
+
+
+def get_computer_settings(hostname):
+    """
+    Return the settings of the fireworks scheduler stored in the Computer.
+
+    The settings are kept as a dictionary in the ``fireworks_scheduler`` property of
+    the Computer, and can be set with ``verdi data fireworks-scheduler configure-computer``.
+    The scheduler only knows the hostname of the Computer through the transport,
+    so the settings of the first Computer using the fireworks scheduler with
+    this hostname are used.
+
+    :returns: A dictionary of the settings, empty if none are found.
+    """
+    qbd = orm.QueryBuilder()
+    qbd.append(orm.Computer,
+               filters={
+                   'hostname': hostname,
+                   'scheduler_type': {
+                       'in': FW_SCHEDULER_TYPES
+                   }
+               })
+    for (computer, ) in qbd.iterall():
+        settings = computer.get_property(SETTINGS_PROPERTY, None)
+        if settings:
+            return dict(settings)
+    return {}
+
+
 def parse_sge_script(local_script_path):
     """
     Parse the SGE script
@@ -378,6 +765,7 @@ def parse_sge_script(local_script_path):
         'stderr_fname': '_scheduler-stderr.txt',
         'priority':
         100,  # Base priority of AiiDA jobs in the FW system, hard coded to 100 for now
+        'hold': False,
     }
 
     for line in lines:
@@ -395,6 +783,8 @@ def parse_sge_script(local_script_path):
             seconds = int(seconds) + int(minutes) * 60 + int(hours) * 3600
             options['walltime'] = int(seconds)
 
+        if '#$ -h' in line:
+            options['hold'] = True
         if '#$ -p ' in line:
             options['priority'] += int(line.split()[-1])
     required_fields = ['job_name', 'mpinp', 'walltime']
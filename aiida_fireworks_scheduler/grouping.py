@@ -0,0 +1,111 @@
+"""
+Grouping the AiiDA jobs submitted together into a single Workflow
+
+By default each job is added as a Workflow of its own, which doubles the number of
+documents written. With grouping, the jobs of a computer submitted within a time
+window are added as independent Fireworks of the same Workflow, up to a maximum
+size, similar to a job array. Each job keeps its own Firework, so that querying,
+killing and running them is not affected.
+"""
+from datetime import datetime, timedelta
+
+from pymongo import DESCENDING
+from fireworks.core.firework import Workflow
+from fireworks.core.launchpad import WFLock, LockedWorkflowError
+
+from aiida_fireworks_scheduler.hold import HELD_STATE, add_workflow, workflow_state
+
+GROUP_KEY = '_aiida_group'
+
+
+def _group_query(computer_id, window, max_size, now):
+    """Query for the open groups of a computer"""
+    return {
+        f'metadata.{GROUP_KEY}.computer_id': computer_id,
+        f'metadata.{GROUP_KEY}.opened_on': {
+            '$gte': now - timedelta(seconds=window)
+        },
+        f'metadata.{GROUP_KEY}.size': {
+            '$lt': max_size
+        },
+        'state': {
+            '$ne': 'ARCHIVED'
+        },
+    }
+
+
+def _append_firework(launchpad, firework, anchor, query):
+    """
+    Append a Firework without any links to the Workflow containing ``anchor``
+
+    :returns: The id of the Firework, or None if the group is no longer open.
+    """
+    with WFLock(launchpad, anchor):
+        # The group may have been filled while waiting for the lock
+        wf_doc = launchpad.workflows.find_one(dict(query, nodes=anchor),
+                                              {'fw_states': 1})
+        if wf_doc is None:
+            return None
+        fw_id = launchpad.get_new_fw_id()
+        firework.fw_id = fw_id
+        if firework.state != HELD_STATE:
+            firework.state = 'READY'
+        launchpad.fireworks.insert_one(firework.to_db_dict())
+        fw_states = dict(wf_doc['fw_states'])
+        fw_states[str(fw_id)] = firework.state
+        launchpad.workflows.update_one({'nodes': anchor}, {
+            '$push': {
+                'nodes': fw_id
+            },
+            '$set': {
+                f'links.{fw_id}': [],
+                f'fw_states.{fw_id}': firework.state,
+                'state': workflow_state(fw_states),
+                'updated_on': datetime.utcnow(),
+            },
+            '$inc': {
+                f'metadata.{GROUP_KEY}.size': 1
+            }
+        })
+    return fw_id
+
+
+def add_grouped_firework(launchpad, firework, window, max_size=100, now=None):
+    """
+    Add the Firework of an AiiDA job to the open group of its computer, or to a new
+    group if there is none.
+
+    :param launchpad: The LaunchPad to add the Firework to.
+    :param firework: An `AiiDAJobFirework`.
+    :param window: Seconds for which a group accepts new jobs after it is opened.
+    :param max_size: Maximum number of jobs in a group.
+    :param now: Current time (UTC), for testing.
+
+    :returns: The id of the Firework added.
+    """
+    now = now or datetime.utcnow()
+    computer_id = firework.spec['_aiida_job_info']['computer_id']
+    query = _group_query(computer_id, window, max_size, now)
+    wf_doc = launchpad.workflows.find_one(
+        query, {'nodes': 1},
+        sort=[(f'metadata.{GROUP_KEY}.opened_on', DESCENDING)])
+    if wf_doc is not None:
+        try:
+            fw_id = _append_firework(launchpad, firework, wf_doc['nodes'][0],
+                                     query)
+        except LockedWorkflowError:
+            fw_id = None
+        if fw_id is not None:
+            return fw_id
+
+    workflow = Workflow([firework],
+                        name=f'AiiDA jobs on {computer_id}',
+                        metadata={
+                            GROUP_KEY: {
+                                'computer_id': computer_id,
+                                'opened_on': now,
+                                'size': 1
+                            }
+                        })
+    mapping = add_workflow(launchpad, workflow)
+    return list(mapping.values())[0]
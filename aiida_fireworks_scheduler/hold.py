@@ -0,0 +1,176 @@
+"""
+Holding AiiDA jobs and releasing them together
+
+Jobs submitted with ``submit_as_hold`` are added to the LaunchPad as PAUSED
+Fireworks, which the workers do not run. They can be released in bulk, for example
+to start thousands of jobs prepared in advance when a reservation begins.
+"""
+from datetime import datetime
+
+from pymongo import UpdateOne
+from fireworks.core.firework import Firework, Workflow
+from fireworks.core.launchpad import WFLock
+
+from aiida_fireworks_scheduler.common import RESERVED_CATEGORY
+
+HELD_STATE = 'PAUSED'
+# Field marking the jobs submitted as held, the only PAUSED jobs that are released
+HELD_FIELD = 'spec._aiida_job_info.held'
+
+
+def hold_firework(firework):
+    """
+    Hold an AiiDA job, so that it is added as PAUSED by `add_workflow` and can be
+    released by `release_jobs`
+    """
+    firework.state = HELD_STATE
+    firework.spec['_aiida_job_info']['held'] = True
+
+
+def add_workflow(launchpad, workflow):
+    """
+    Add a Workflow (or a Firework) to the LaunchPad as `LaunchPad.add_wf`, except
+    that the root Fireworks that are PAUSED are kept held rather than set to READY.
+
+    :returns: The mapping between the old and new Firework ids.
+    """
+    if isinstance(workflow, Firework):
+        workflow = Workflow.from_Firework(workflow)
+    held = [
+        fw_id for fw_id in workflow.root_fw_ids
+        if workflow.id_fw[fw_id].state == HELD_STATE
+    ]
+    if not held:
+        return launchpad.add_wf(workflow)
+
+    for fw_id in workflow.root_fw_ids:
+        if fw_id not in held:
+            workflow.id_fw[fw_id].state = 'READY'
+            workflow.fw_states[fw_id] = 'READY'
+    old_new = launchpad._upsert_fws(list(workflow.id_fw.values()),  # pylint: disable=protected-access
+                                    reassign_all=True)
+    workflow._reassign_ids(old_new)  # pylint: disable=protected-access
+    launchpad.workflows.insert_one(workflow.to_db_dict())
+    return old_new
+
+
+def workflow_state(fw_states):
+    """
+    State of a Workflow of independent Fireworks from their states, following
+    `Workflow.state`
+    """
+    states = list(fw_states.values())
+    if all(state == 'COMPLETED' for state in states):
+        return 'COMPLETED'
+    if all(state == 'ARCHIVED' for state in states):
+        return 'ARCHIVED'
+    for state in ('DEFUSED', 'PAUSED', 'FIZZLED'):
+        if state in states:
+            return state
+    if 'COMPLETED' in states or 'RUNNING' in states:
+        return 'RUNNING'
+    if 'RESERVED' in states:
+        return 'RESERVED'
+    return 'READY'
+
+
+def release_jobs(launchpad, fw_ids=None, computer_id=None):
+    """
+    Release the AiiDA jobs held with `hold_firework`, leaving those paused by other
+    means, e.g. by an operator with ``lpad pause_fws``. The jobs with a Workflow of their own are released
+    with one bulk write for their Workflows, followed by a single update of the
+    Fireworks, so that they cannot be checked out before their Workflows are updated.
+
+    The Workflows grouping several jobs are updated one at a time with their jobs,
+    while holding their locks, as the other jobs in them may be checked out or
+    completed at the same time.
+
+    :param launchpad: The LaunchPad to update.
+    :param fw_ids: Only release the jobs of these Firework ids, if given.
+    :param computer_id: Only release the jobs of this computer, if given.
+
+    :returns: The ids of the Fireworks released.
+    """
+    query = {
+        'spec._category': RESERVED_CATEGORY,
+        'state': HELD_STATE,
+        HELD_FIELD: True
+    }
+    if fw_ids is not None:
+        query['fw_id'] = {'$in': [int(fw_id) for fw_id in fw_ids]}
+    if computer_id is not None:
+        query['spec._aiida_job_info.computer_id'] = computer_id
+    released = launchpad.fireworks.distinct('fw_id', query)
+    if not released:
+        return []
+    released_set = set(released)
+
+    now = datetime.utcnow()
+    single = []
+    requests = []
+    grouped = []
+    for wf_doc in launchpad.workflows.find({'nodes': {
+            '$in': released
+    }}, {
+            'nodes': 1,
+            'metadata': 1
+    }):
+        # A group may have a single job so far, but others can be added to it
+        if len(wf_doc['nodes']) > 1 or wf_doc.get('metadata'):
+            grouped.append(wf_doc)
+            continue
+        fw_id = wf_doc['nodes'][0]
+        single.append(fw_id)
+        requests.append(
+            UpdateOne({'_id': wf_doc['_id']}, {
+                '$set': {
+                    f'fw_states.{fw_id}': 'READY',
+                    'state': workflow_state({fw_id: 'READY'}),
+                    'updated_on': now
+                }
+            }))
+    if requests:
+        launchpad.workflows.bulk_write(requests, ordered=False)
+        _set_ready(launchpad, query, single, now)
+
+    for wf_doc in grouped:
+        with WFLock(launchpad, wf_doc['nodes'][0]):
+            wf_doc = launchpad.workflows.find_one({'_id': wf_doc['_id']}, {
+                'nodes': 1,
+                'fw_states': 1
+            })
+            _set_ready(launchpad, query, [
+                fw_id for fw_id in wf_doc['nodes'] if fw_id in released_set
+            ], now)
+            fw_states = dict(wf_doc['fw_states'])
+            fw_states.update({
+                str(doc['fw_id']): doc['state']
+                for doc in launchpad.fireworks.find(
+                    {'fw_id': {
+                        '$in': wf_doc['nodes']
+                    }}, {
+                        'fw_id': 1,
+                        'state': 1
+                    })
+            })
+            launchpad.workflows.update_one({'_id': wf_doc['_id']}, {
+                '$set': {
+                    'fw_states': fw_states,
+                    'state': workflow_state(fw_states),
+                    'updated_on': now
+                }
+            })
+    return released
+
+
+def _set_ready(launchpad, query, fw_ids, now):
+    """Set the held Fireworks matching ``query`` among ``fw_ids`` to READY"""
+    launchpad.fireworks.update_many(dict(query, fw_id={'$in': fw_ids}), {
+        '$set': {
+            'state': 'READY',
+            'updated_on': now
+        },
+        '$unset': {
+            HELD_FIELD: ''
+        }
+    })
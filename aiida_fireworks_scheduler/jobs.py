@@ -2,39 +2,131 @@
 Mapping AiiDA scheduler jobs to `Firework`
 """
 
+import json
+import os
 from string import Template
 from fireworks.user_objects.firetasks.script_task import ScriptTask
-from fireworks.core.firework import Firework
+from fireworks.core.firework import Firework, FiretaskBase, FWAction
+from fireworks.utilities.fw_utilities import explicit_serialize
 from aiida_fireworks_scheduler.common import RESERVED_CATEGORY
+from aiida_fireworks_scheduler.usage import USAGE_FILE
+
+# Written to the working directory when the job is killed at its walltime
+TIMEOUT_FILE = '_fw_timeout'
+# Environment variable holding the walltime of the job, set from its spec
+WALLTIME_ENV = 'AIIDA_FW_WALLTIME'
 
 # Here the goal is to run the script in an environment as close to that will be used by
 # the actual scheduler as possible.
 
-# Here the command assumes that the runtime environment sources the .bashrc, e.g. it is a login shell.
-# This is known to be untrue the case for SLURM, but here we still want to have this behaviour
-# well defined.
-
-# This execute the _aiidasubmit.sh in a fresh login shell. No information about the scheduler is kept to make it sample,
-# not suitable for SLURM which needs environmental variables for alunching job steps with `srun`
+# The _aiidasubmit.sh is executed in the background using the `shell_command` (after
+# running the `shell_setup` commands), and is killed if an AIIDA_STOP file appears in
+# the working directory.
+#
+# If a staging folder is set, either for the job or through the AIIDA_FW_STAGE_DIR
+# environment variable of the worker, the working directory is copied to a new
+# folder under it and the job runs there. The results are copied back when the
+# script exits, including when the job is stopped or timed out, and the time taken
+# is written to _fw_staging.txt.
+#
+# If the launcher sets AIIDA_FW_CORE_STATE, a set of cores not used by the other jobs
+# running on the node is acquired, and the job is pinned to it with `taskset`. The
+# cores are also passed to the job as AIIDA_FW_CPUS. If AIIDA_FW_NODEFILE is set as
+# well, slots on the nodes of the allocation are acquired instead, and passed to the
+# job as a host file (AIIDA_FW_HOSTFILE) and a list of nodes (AIIDA_FW_NODELIST).
+#
+# If AIIDA_FW_USAGE_INTERVAL is set, the resource usage of the job is sampled at that
+# interval in the background and summarised in _fw_usage.json, which is attached to
+# the launch by the AttachUsageTask.
+#
+# The walltime is passed by the JobScriptTask as AIIDA_FW_WALLTIME, read from the spec
+# of the Firework so that it can be raised when the job is requeued. A job that exits
+# before the end of its script (e.g. with an error) is not taken as timed out. If the
+# job is killed at its walltime, _fw_timeout is written to the working directory, and
+# the CheckTimeoutTask either fails the launch for the job to be requeued, or records
+# the timeout in the launch.
 RUN_SCRIPT_TEMPLATE = Template(r"""
+WORK_DIR=$$PWD
+STAGE_DIR=""
+SAMPLER_PID=""
+STAGE_ROOT="${stage_dir}"
+STAGE_ROOT="$${STAGE_ROOT:-$$AIIDA_FW_STAGE_DIR}"
+rm -f "$$WORK_DIR/${timeout_fname}"
+
 printf "\ntouch .FINISHED" >> ${submit_script_name}
 chmod +x ${submit_script_name}
 
-timeout ${walltime_seconds}s env -i HOME=$$HOME bash -l ./${submit_script_name} > ${stdout_fname} 2> ${stderr_fname} & 
+if [[ -n "$$AIIDA_FW_NODEFILE" ]]; then
+    AIIDA_FW_NODELIST=$$("$${AIIDA_FW_PYTHON:-python}" -m aiida_fireworks_scheduler.placement acquire-nodes "$$AIIDA_FW_CORE_STATE" "$$AIIDA_FW_NODEFILE" "$$AIIDA_FW_PPN" ${mpinp} $$$$ "$$WORK_DIR/_fw_hostfile")
+    if [[ -n "$$AIIDA_FW_NODELIST" ]]; then
+        export AIIDA_FW_NODELIST AIIDA_FW_HOSTFILE="$$WORK_DIR/_fw_hostfile"
+    fi
+elif [[ -n "$$AIIDA_FW_CORE_STATE" ]]; then
+    AIIDA_FW_CPUS=$$("$${AIIDA_FW_PYTHON:-python}" -m aiida_fireworks_scheduler.placement acquire "$$AIIDA_FW_CORE_STATE" ${mpinp} $$$$)
+    export AIIDA_FW_CPUS
+fi
+${shell_setup}
+if [[ -n "$$STAGE_ROOT" ]]; then
+    STAGE_START=$$SECONDS
+    if STAGE_DIR=$$(mktemp -d "$$STAGE_ROOT/aiida-fw-XXXXXX") && cp -a ./. "$$STAGE_DIR"/ && cd "$$STAGE_DIR"; then
+        echo "stage_in_seconds=$$((SECONDS - STAGE_START))" > "$$WORK_DIR/_fw_staging.txt"
+    else
+        echo "Cannot stage the job in $$STAGE_ROOT, running it in $$WORK_DIR" >&2
+        if [[ -n "$$STAGE_DIR" ]]; then
+            rm -rf "$$STAGE_DIR"
+        fi
+        STAGE_DIR=""
+    fi
+    stage_out() {
+        STAGE_START=$$SECONDS
+        cp -a ./. "$$WORK_DIR"/ && cd "$$WORK_DIR" && rm -rf "$$STAGE_DIR"
+        echo "stage_out_seconds=$$((SECONDS - STAGE_START))" >> "$$WORK_DIR/_fw_staging.txt"
+    }
+fi
+
+cleanup() {
+    if [[ -n "$$SAMPLER_PID" ]]; then
+        wait $$SAMPLER_PID
+    fi
+    if [[ -n "$$STAGE_DIR" ]]; then
+        stage_out
+    fi
+    if [[ -n "$$AIIDA_FW_CORE_STATE" ]]; then
+        "$${AIIDA_FW_PYTHON:-python}" -m aiida_fireworks_scheduler.placement release "$$AIIDA_FW_CORE_STATE" $$$$
+    fi
+}
+trap cleanup EXIT
+
+timeout $${AIIDA_FW_WALLTIME:-${walltime_seconds}}s $${AIIDA_FW_CPUS:+taskset -c $$AIIDA_FW_CPUS} ${shell_command} ./${submit_script_name} > ${stdout_fname} 2> ${stderr_fname} & 
+JOB_PID=$$!
+if [[ -n "$$AIIDA_FW_USAGE_INTERVAL" ]]; then
+    rm -f "$$WORK_DIR/${usage_fname}"
+    "$${AIIDA_FW_PYTHON:-python}" -m aiida_fireworks_scheduler.usage $$JOB_PID "$$AIIDA_FW_USAGE_INTERVAL" "$$WORK_DIR/${usage_fname}" &
+    SAMPLER_PID=$$!
+fi
 sleep 1
 chmod -x ${submit_script_name}
 
-while [[ -e /proc/$$! ]]; do
-    if [[ -e AIIDA_STOP ]]; then
-       kill $$!
+while [[ -e /proc/$$JOB_PID ]]; do
+    if [[ -e "$$WORK_DIR/AIIDA_STOP" ]]; then
+       kill $$JOB_PID
+       # Let the job exit before its files are staged out
+       wait $$JOB_PID
        exit 11
     fi
     sleep 5
 done
 
-if [ ! -f .FINISHED ]; then
+# The exit status of `timeout` is 124 if the job was killed at its walltime
+wait $$JOB_PID
+JOB_RC=$$?
+if [[ $$JOB_RC -eq 124 ]]; then
     echo Script timed out
+    touch "$$WORK_DIR/${timeout_fname}"
     exit 12
+elif [ ! -f .FINISHED ]; then
+    echo Script failed with exit status $$JOB_RC
+    exit 13
 else
     rm .FINISHED
 fi
@@ -42,33 +134,104 @@ fi
 echo ALL DONE
 """)
 
+# This execute the _aiidasubmit.sh in a fresh login shell. No information about the scheduler is kept to make it sample,
+# not suitable for SLURM which needs environmental variables for alunching job steps with `srun`.
+# Here the command assumes that the runtime environment sources the .bashrc, e.g. it is a login shell.
+# This is known to be untrue the case for SLURM, but here we still want to have this behaviour
+# well defined.
+# If AIIDA_FW_ENV_CACHE is set, the clean login environment is captured once into that file
+# (exported variables and functions) and restored for each job, instead of sourcing the
+# login profile every time. The cache is only used if it and its directory are owned by
+# the user and not writable by others. The placement of the job is passed through.
+FRESH_ENV_SETUP = r"""
+JOB_ENV=()
+for name in AIIDA_FW_CPUS AIIDA_FW_NODELIST AIIDA_FW_HOSTFILE; do
+    if [[ -n "${!name}" ]]; then
+        JOB_ENV+=("$name=${!name}")
+    fi
+done
+if [[ -n "$AIIDA_FW_ENV_CACHE" ]]; then
+    for path in "$(dirname "$AIIDA_FW_ENV_CACHE")" "$AIIDA_FW_ENV_CACHE"; do
+        if [[ -e "$path" ]] && [[ ! -O "$path" || -n "$(find "$path" -prune -perm /022)" ]]; then
+            echo "Not using the login environment cache $AIIDA_FW_ENV_CACHE, which is not private" >&2
+            AIIDA_FW_ENV_CACHE=
+            break
+        fi
+    done
+fi
+if [[ -n "$AIIDA_FW_ENV_CACHE" ]]; then
+    if [[ ! -s "$AIIDA_FW_ENV_CACHE" ]]; then
+        (umask 077; env -i HOME="$HOME" bash -l -c 'export -p; declare -fx' 2> /dev/null \
+            | grep -v -e '^declare -x \(PWD\|OLDPWD\|SHLVL\)=' > "$AIIDA_FW_ENV_CACHE.$$")
+        mv "$AIIDA_FW_ENV_CACHE.$$" "$AIIDA_FW_ENV_CACHE"
+    fi
+    FRESH_ENV=(env -i HOME="$HOME" "${JOB_ENV[@]}" bash --noprofile --norc -c 'source "$0"; exec bash "$@"' "$AIIDA_FW_ENV_CACHE")
+else
+    FRESH_ENV=(env -i HOME="$HOME" "${JOB_ENV[@]}" bash -l)
+fi
+"""
+FRESH_ENV_SHELL = '"${FRESH_ENV[@]}"'
+
 # Execute our _aiidasubmit.sh directly in a shell launched by the current environment.
 # This is needed for advanced schedulers with job step support
-RUN_SCRIPT_TEMPLATE_KEEP_ENV = Template(r"""
-printf "\ntouch .FINISHED" >> ${submit_script_name}
-chmod +x ${submit_script_name}
+KEEP_ENV_SHELL = 'bash'
 
-timeout ${walltime_seconds}s bash ./${submit_script_name} > ${stdout_fname} 2> ${stderr_fname} & 
-sleep 1
-chmod -x ${submit_script_name}
 
-while [[ -e /proc/$$! ]]; do
-    if [[ -e AIIDA_STOP ]]; then
-       kill $$!
-       exit 11
-    fi
-    sleep 5
-done
+@explicit_serialize
+class AttachUsageTask(FiretaskBase):
+    """
+    Attach the resource usage sampled during the job to the launch
+    """
+    def run_task(self, fw_spec):
+        if not os.path.isfile(USAGE_FILE):
+            return None
+        with open(USAGE_FILE) as fhandle:
+            usage = json.load(fhandle)
+        return FWAction(stored_data={'usage': usage})
 
-if [ ! -f .FINISHED ]; then
-    echo Script timed out
-    exit 12
-else
-    rm .FINISHED
-fi
 
-echo ALL DONE
-""")
+@explicit_serialize
+class JobScriptTask(ScriptTask):
+    """
+    Run the script of an AiiDA job, with the walltime taken from the spec
+    """
+    def run_task(self, fw_spec):
+        os.environ[WALLTIME_ENV] = str(fw_spec['_aiida_job_info']['walltime'])
+        return super().run_task(fw_spec)
+
+
+class JobTimeoutError(RuntimeError):
+    """The job was killed at its walltime and should be requeued"""
+    def __init__(self, walltime, computer_id=None):
+        super().__init__(
+            f'The job reached its walltime of {walltime} seconds and is requeued'
+        )
+        self.walltime = walltime
+        self.computer_id = computer_id
+
+    def to_dict(self):
+        """Details stored in the launch, used for finding the jobs to requeue"""
+        return {
+            'timeout': True,
+            'walltime': self.walltime,
+            'computer_id': self.computer_id
+        }
+
+
+@explicit_serialize
+class CheckTimeoutTask(FiretaskBase):
+    """
+    Check if the job was killed at its walltime. The launch fails if the job can be
+    requeued, so that the job is not seen as finished by AiiDA, otherwise the timeout
+    is recorded in the launch.
+    """
+    def run_task(self, fw_spec):
+        if not os.path.isfile(TIMEOUT_FILE):
+            return None
+        info = fw_spec['_aiida_job_info']
+        if info.get('requeues', 0) < info.get('max_requeues', 0):
+            raise JobTimeoutError(info['walltime'], info['computer_id'])
+        return FWAction(stored_data={'timeout': True})
 
 
 class AiiDAJobFirework(Firework):
@@ -87,10 +250,20 @@ class AiiDAJobFirework(Firework):
             stdout_fname,
             stderr_fname,
             fresh_env=True,
-            priority=100):
+            priority=100,
+            stage_dir=None,
+            max_requeues=0):
         """
         Instantiate a Firework to run jobs prepared by AiiDA daemon on the remote
         computer
+
+        :param fresh_env: Run the job in a fresh login shell rather than in the
+          environment of the launcher.
+        :param priority: Priority of the Firework.
+        :param stage_dir: Folder on the compute node (e.g. ``$TMPDIR``) to copy the
+          working directory to for running the job.
+        :param max_requeues: Number of times the job is requeued if it is killed at its
+          walltime.
         """
         spec = {
             '_aiida_job_info': {
@@ -100,24 +273,30 @@ class AiiDAJobFirework(Firework):
                 'submit_script_name': submit_script_name,
                 'mpinp': mpinp,  # Resources - used for job selection
                 'walltime': walltime,  # in seconds
+                'max_requeues': max_requeues,
             },
             # Category set it to a special values to indicate it is an AiiDA job
             '_category': RESERVED_CATEGORY,
             '_launch_dir': remote_work_dir,
             '_priority': priority,
         }
-        if fresh_env:
-            template = RUN_SCRIPT_TEMPLATE
-        else:
-            template = RUN_SCRIPT_TEMPLATE_KEEP_ENV
-
-        script = template.substitute(submit_script_name=submit_script_name,
-                                     walltime_seconds=walltime,
-                                     stdout_fname=stdout_fname,
-                                     stderr_fname=stderr_fname)
-        task = ScriptTask(script=script,
-                          shell_exe='/bin/bash',
-                          fizzle_bad_rc=False,
-                          defuse_bad_rc=False)
-
-        super().__init__(tasks=[task], spec=spec, name=job_name)
+        script = RUN_SCRIPT_TEMPLATE.substitute(
+            submit_script_name=submit_script_name,
+            walltime_seconds=walltime,
+            mpinp=mpinp,
+            usage_fname=USAGE_FILE,
+            timeout_fname=TIMEOUT_FILE,
+            stdout_fname=stdout_fname,
+            stderr_fname=stderr_fname,
+            shell_setup=FRESH_ENV_SETUP if fresh_env else '',
+            shell_command=FRESH_ENV_SHELL if fresh_env else KEEP_ENV_SHELL,
+            stage_dir=stage_dir or '')
+        task = JobScriptTask(script=script,
+                             shell_exe='/bin/bash',
+                             fizzle_bad_rc=False,
+                             defuse_bad_rc=False)
+
+        super().__init__(tasks=[task, AttachUsageTask(),
+                                CheckTimeoutTask()],
+                         spec=spec,
+                         name=job_name)
@@ -0,0 +1,508 @@
+"""
+Helpers for working with the `LaunchPad` used by the AiiDA jobs
+"""
+import datetime
+import os
+import threading
+import time
+import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from monty.serialization import loadfn
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+from pymongo.read_preferences import (PrimaryPreferred, Secondary,
+                                      SecondaryPreferred, Nearest)
+
+from fireworks.core.launchpad import LaunchPad
+from fireworks.fw_config import LAUNCHPAD_LOC, SORT_FWS
+
+from aiida_fireworks_scheduler.common import RESERVED_CATEGORY
+
+DEFAULT_MAX_POOL_SIZE = 20
+
+# Field of the Fireworks holding the expiry time of the lease of a running AiiDA job
+LEASE_FIELD = 'aiida_lease'
+# States of the Fireworks held by a lease
+LEASED_STATES = ['RESERVED', 'RUNNING']
+
+# Smallest maximum replication lag in seconds accepted by MongoDB for the secondaries
+MIN_MAX_STALENESS = 90
+# Read preferences that can be used for the read-only queries, other than 'primary'
+READ_PREFERENCES = {
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+# Indexes used by the queries made by this plugin, as a list of
+# (collection name, keys, options) tuples
+AIIDA_INDEXES = [
+    # Listing the active jobs of a computer in FwScheduler.get_jobs
+    ('fireworks', [('spec._aiida_job_info.computer_id', ASCENDING),
+                   ('state', ASCENDING)], {}),
+    # A single Firework for the working directory of each job, so that a repeated
+    # submission cannot add another one
+    ('fireworks', [('spec._aiida_job_info.computer_id', ASCENDING),
+                   ('spec._aiida_job_info.remote_work_dir', ASCENDING)], {
+                       'unique': True,
+                       'partialFilterExpression': {
+                           'spec._category': RESERVED_CATEGORY
+                       }
+                   }),
+    # Checking out the AiiDA jobs with AiiDAFWorker.get_aiida_queries: equality
+    # conditions first, then the sort keys and the range of the walltime
+    ('fireworks', [('state', ASCENDING),
+                   ('spec._aiida_job_info.computer_id', ASCENDING),
+                   ('spec._aiida_job_info.username', ASCENDING),
+                   ('spec._aiida_job_info.mpinp', DESCENDING),
+                   ('spec._priority', DESCENDING),
+                   ('spec._aiida_job_info.walltime', ASCENDING)], {
+                       'name': 'aiida_checkout',
+                       'partialFilterExpression': {
+                           'spec._category': RESERVED_CATEGORY
+                       }
+                   }),
+    # Checking out the other Fireworks with AiiDAFWorker.get_fireworks_query
+    ('fireworks', [('state', ASCENDING), ('spec._category', ASCENDING),
+                   ('spec._priority', DESCENDING), ('spec._fworker', ASCENDING),
+                   ('spec._walltime_seconds', ASCENDING)], {
+                       'name': 'fireworks_checkout'
+                   }),
+    # Expired leases of the AiiDA jobs
+    ('fireworks', [(LEASE_FIELD, ASCENDING)], {
+        'sparse': True
+    }),
+    # Launches of the jobs killed at their walltime, to be requeued
+    ('launches', [('action.stored_data._exception._details.timeout',
+                   ASCENDING)], {
+                       'sparse': True
+                   }),
+    # Recently finished launches for the fair share of the workers
+    ('launches', [('time_end', ASCENDING)], {}),
+    # Open groups of jobs of a computer when grouping the submissions
+    ('workflows', [('metadata._aiida_group.computer_id', ASCENDING),
+                   ('metadata._aiida_group.opened_on', DESCENDING)], {
+                       'sparse': True
+                   }),
+]
+
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+_INDEXED = weakref.WeakSet()
+_EXECUTORS = {}
+
+
+def ensure_indexes(launchpad):
+    """
+    Create the indexes used for querying AiiDA jobs, if they do not exist already.
+    This is only done once for each `LaunchPad` instance.
+
+    :param launchpad: The `LaunchPad` to create the indexes for
+    """
+    if launchpad in _INDEXED:
+        return
+    for collection, keys, options in AIIDA_INDEXES:
+        try:
+            launchpad.db[collection].create_index(keys,
+                                                  background=True,
+                                                  **options)
+        except OperationFailure as error:
+            # e.g. a unique index cannot be built over existing duplicates
+            warnings.warn(
+                f'Cannot create the index {keys} of {collection}: {error}')
+    _INDEXED.add(launchpad)
+
+
+def is_uri(location):
+    """Return True if the location is a MongoDB connection string"""
+    return location.startswith(('mongodb://', 'mongodb+srv://'))
+
+
+def _normalise_location(location):
+    """The location of a launchpad file or a MongoDB URI, used as a registry key"""
+    location = location or LAUNCHPAD_LOC
+    if location and not is_uri(location):
+        location = os.path.abspath(os.path.expanduser(location))
+    return location
+
+
+def get_launchpad(location=None, max_pool_size=DEFAULT_MAX_POOL_SIZE):
+    """
+    Return the shared `LaunchPad` for a launchpad file or a MongoDB URI.
+
+    One `LaunchPad` is created for each distinct location and kept for the lifetime
+    of the process, so that the computers using it share a single thread-safe
+    connection pool, while those using other launchpads do not.
+
+    :param location: Path to the launchpad file or a ``mongodb://`` URI.
+      Default to the ``LAUNCHPAD_LOC`` of the fireworks configuration.
+    :param max_pool_size: Maximum size of the connection pool, only used when the
+      `LaunchPad` is created and if not set in the launchpad file or URI.
+    """
+    location = _normalise_location(location)
+    with _REGISTRY_LOCK:
+        if location not in _REGISTRY:
+            launchpad = _create_launchpad(location, max_pool_size)
+            ensure_indexes(launchpad)
+            _REGISTRY[location] = launchpad
+        return _REGISTRY[location]
+
+
+def get_executor(location=None, max_workers=DEFAULT_MAX_POOL_SIZE):
+    """
+    Return the thread pool for running blocking calls to the `LaunchPad` of a
+    location, including connecting to it.
+
+    Each location has its own pool, sized to match the connection pool of its
+    `LaunchPad` and kept for the lifetime of the process as the `LaunchPad` itself.
+
+    :param location: Path to the launchpad file or a ``mongodb://`` URI, as for
+      `get_launchpad`.
+    :param max_workers: Number of threads, only used when the pool is created
+    """
+    location = _normalise_location(location)
+    with _REGISTRY_LOCK:
+        if location not in _EXECUTORS:
+            _EXECUTORS[location] = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix='fw-launchpad')
+        return _EXECUTORS[location]
+
+
+def get_read_collection(launchpad,
+                        collection,
+                        read_preference=None,
+                        max_staleness=-1):
+    """
+    Return a collection of the `LaunchPad` for read-only queries that can tolerate
+    stale data, such as polling for the job states.
+
+    :param launchpad: The `LaunchPad` to use
+    :param collection: Name of the collection
+    :param read_preference: Name of the read preference, one of `READ_PREFERENCES`.
+      The primary is used if not set.
+    :param max_staleness: Maximum replication lag in seconds of the secondaries to
+      read from (at least 90), -1 for no limit.
+    """
+    if read_preference in (None, 'primary'):
+        return launchpad.db[collection]
+    try:
+        mode = READ_PREFERENCES[read_preference]
+    except KeyError:
+        raise ValueError(f"Unknown read preference: {read_preference}")
+    if max_staleness != -1 and max_staleness < MIN_MAX_STALENESS:
+        raise ValueError(
+            f"The maximum staleness must be -1 or at least {MIN_MAX_STALENESS} "
+            f"seconds, got {max_staleness}")
+    return launchpad.db[collection].with_options(
+        read_preference=mode(max_staleness=max_staleness))
+
+
+class QuerySequence(dict):
+    """
+    Query of a worker made of alternatives, which are tried in order when checking
+    out a Firework with an `AiiDALaunchPad`.
+
+    The query itself matches any of the alternatives, so it can be used in place
+    of a plain query elsewhere.
+    """
+    def __init__(self, queries, sorts=None):
+        """
+        :param queries: A list of the alternative queries, in the order of preference
+        :param sorts: A list of the sort keys to apply to each alternative before the
+          priority of the Fireworks, or None
+        """
+        queries = list(queries)
+        super().__init__({'$or': queries} if len(queries) > 1 else queries[0])
+        self.queries = queries
+        self.sorts = list(sorts) if sorts else [None] * len(queries)
+
+
+class AiiDALaunchPad(LaunchPad):
+    """
+    `LaunchPad` used by the launcher of AiiDA jobs, which checks out Fireworks using
+    the alternatives of a `QuerySequence` in order.
+
+    If ``lease_seconds`` is set, the AiiDA jobs checked out hold a lease which is
+    renewed by a background thread until they are completed. The jobs of a launcher
+    that died stop being renewed, and can be recovered once their lease expires,
+    see `maintenance.recover_lost_jobs`.
+
+    The workers passed in are kept by their names, with this LaunchPad attached to
+    them. With ``arlaunch multi``, the LaunchPad is shared through a server process
+    and each call receives a copy of the worker rebuilt from its dictionary, which
+    would lose the state of its estimator, fair share and compiled query.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lease_seconds = None
+        self._leased = {}
+        self._lease_lock = threading.Lock()
+        self._heartbeat = None
+        self._workers = {}
+
+    def keep_worker(self, fworker):
+        """
+        Return the worker kept for the name of ``fworker``, keeping it if there is
+        none. Workers without a LaunchPad to attach are returned as they are.
+        """
+        if fworker is None or not hasattr(fworker, 'attach_launchpad'):
+            return fworker
+        with self._lease_lock:
+            kept = self._workers.setdefault(fworker.name, fworker)
+        if kept is fworker:
+            fworker.attach_launchpad(self)
+        return kept
+
+    def run_exists(self, fworker=None):
+        return super().run_exists(self.keep_worker(fworker))
+
+    def future_run_exists(self, fworker=None):
+        return super().future_run_exists(self.keep_worker(fworker))
+
+    def checkout_fw(self,
+                    fworker,
+                    launch_dir,
+                    fw_id=None,
+                    host=None,
+                    ip=None,
+                    state="RUNNING"):
+        m_fw, launch_id = super().checkout_fw(self.keep_worker(fworker),
+                                              launch_dir,
+                                              fw_id=fw_id,
+                                              host=host,
+                                              ip=ip,
+                                              state=state)
+        if m_fw and self.lease_seconds and m_fw.spec.get(
+                '_category') == RESERVED_CATEGORY:
+            with self._lease_lock:
+                self._leased[launch_id] = m_fw.fw_id
+            self.renew_leases([m_fw.fw_id])
+            self._start_heartbeat()
+        return m_fw, launch_id
+
+    def complete_launch(self, launch_id, action=None, state="COMPLETED"):
+        with self._lease_lock:
+            self._leased.pop(launch_id, None)
+        return super().complete_launch(launch_id, action=action, state=state)
+
+    def renew_leases(self, fw_ids):
+        """Renew the leases of the Fireworks of running AiiDA jobs in a single update"""
+        expiry = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=self.lease_seconds)
+        self.fireworks.update_many(
+            {
+                'fw_id': {
+                    '$in': list(fw_ids)
+                },
+                'state': {
+                    '$in': LEASED_STATES
+                }
+            }, {'$set': {
+                LEASE_FIELD: expiry
+            }})
+
+    def _start_heartbeat(self):
+        """Start the thread renewing the leases, unless it is running already"""
+        with self._lease_lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(target=self._renew_loop,
+                                               name='aiida-lease',
+                                               daemon=True)
+            self._heartbeat.start()
+
+    def _renew_loop(self):
+        """Renew the leases of all the jobs running, a few times per lease"""
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lease_lock:
+                fw_ids = list(self._leased.values())
+            if not fw_ids:
+                continue
+            try:
+                self.renew_leases(fw_ids)
+            except PyMongoError as error:
+                self.m_logger.warning(f'Failed to renew the leases: {error}')
+
+    def _get_a_fw_to_run(self, query=None, fw_id=None, checkout=True):
+        queries = getattr(query, 'queries', None)
+        if fw_id or not queries:
+            return super()._get_a_fw_to_run(query, fw_id, checkout)
+        for sub_query, sort in zip(queries, query.sorts):
+            if sort:
+                m_fw = self._get_a_sorted_fw_to_run(sub_query, sort, checkout)
+            else:
+                m_fw = super()._get_a_fw_to_run(sub_query, None, checkout)
+            if m_fw:
+                return m_fw
+        return None
+
+    def _get_a_sorted_fw_to_run(self, query, sort, checkout=True):
+        """
+        Get the next ready Firework to run as `_get_a_fw_to_run`, with the sort keys
+        applied before the priority.
+        """
+        m_query = dict(query)
+        m_query['state'] = 'READY'
+        sortby = checkout_sort(sort)
+
+        while True:
+            if checkout:
+                m_fw = self.fireworks.find_one_and_update(
+                    m_query, {
+                        '$set': {
+                            'state': 'RESERVED',
+                            'updated_on': datetime.datetime.utcnow()
+                        }
+                    },
+                    sort=sortby)
+            else:
+                m_fw = self.fireworks.find_one(m_query, {
+                    'fw_id': 1,
+                    'spec': 1
+                },
+                                               sort=sortby)
+            if not m_fw:
+                return None
+            m_fw = self.get_fw_by_id(m_fw['fw_id'])
+            if self._check_fw_for_uniqueness(m_fw):
+                return m_fw
+
+    @classmethod
+    def from_dict(cls, d):
+        # The method of the base class always creates a plain LaunchPad
+        return cls(d['host'],
+                   d.get('port'),
+                   d.get('name'),
+                   d.get('username'),
+                   d.get('password'),
+                   d.get('logdir'),
+                   d.get('strm_lvl'),
+                   d.get('user_indices', []),
+                   d.get('wf_user_indices', []),
+                   d.get('authsource'),
+                   d.get('uri_mode', False),
+                   d.get('mongoclient_kwargs'))
+
+
+def checkout_sort(sort=None):
+    """
+    Sort keys used for checking out a Firework, which are the priority and the
+    creation time as in `LaunchPad`, preceded by those given.
+    """
+    sortby = list(sort or []) + [('spec._priority', DESCENDING)]
+    if SORT_FWS.upper() == 'FIFO':
+        sortby.append(('created_on', ASCENDING))
+    elif SORT_FWS.upper() == 'FILO':
+        sortby.append(('created_on', DESCENDING))
+    return sortby
+
+
+def _plan_stages(plan):
+    """Names of the indexes scanned by a query plan, or COLLSCAN"""
+    stages = []
+    if plan.get('stage') == 'IXSCAN':
+        stages.append(plan.get('indexName'))
+    elif plan.get('stage') == 'COLLSCAN':
+        stages.append('COLLSCAN')
+    children = plan.get('inputStages', [])
+    if 'inputStage' in plan:
+        children = [plan['inputStage']] + children
+    for child in children:
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+def explain_checkout(launchpad, query):
+    """
+    Explain the queries made for checking out a Firework with a worker query
+
+    Each alternative of a `QuerySequence` is explained separately, with the state and
+    the sort keys added as in `AiiDALaunchPad._get_a_fw_to_run`.
+
+    :param launchpad: The LaunchPad to query.
+    :param query: The query of the worker.
+
+    :returns: A list of dictionaries with the query, the indexes used (or COLLSCAN),
+      the numbers of keys and documents examined and returned, and the time taken
+      in milliseconds, for each alternative.
+    """
+    queries = getattr(query, 'queries', None) or [query]
+    sorts = getattr(query, 'sorts', None) or [None] * len(queries)
+    summaries = []
+    for sub_query, sort in zip(queries, sorts):
+        m_query = dict(sub_query)
+        m_query['state'] = 'READY'
+        result = launchpad.db.command(
+            'explain', {
+                'find': launchpad.fireworks.name,
+                'filter': m_query,
+                'sort': dict(checkout_sort(sort)),
+                'limit': 1
+            },
+            verbosity='executionStats')
+        # Newer servers nest the plan under queryPlan
+        winning = result['queryPlanner']['winningPlan']
+        winning = winning.get('queryPlan', winning)
+        stats = result['executionStats']
+        summaries.append({
+            'query': m_query,
+            'indexes': _plan_stages(winning),
+            'keys_examined': stats['totalKeysExamined'],
+            'docs_examined': stats['totalDocsExamined'],
+            'returned': stats['nReturned'],
+            'time_ms': stats['executionTimeMillis'],
+        })
+    return summaries
+
+
+class LaunchPadClient:
+    """
+    Base class for the objects of a worker making their own queries to the
+    `LaunchPad`. A new connection is made after the process is forked (e.g. by
+    ``arlaunch multi``), as those of pymongo cannot be shared by processes.
+    """
+    _launchpad = None
+    _pid = None
+
+    @property
+    def launchpad(self):
+        """The `LaunchPad` to query"""
+        if self._launchpad is not None and self._pid != os.getpid():
+            self._launchpad = LaunchPad.from_dict(self._launchpad.to_dict())
+            self._pid = os.getpid()
+        return self._launchpad
+
+    @launchpad.setter
+    def launchpad(self, value):
+        self._launchpad = value
+        self._pid = os.getpid()
+
+
+def _uri_with_pool_size(uri, max_pool_size):
+    """Add the pool size to a connection string, unless it is already there"""
+    if 'maxpoolsize=' in uri.lower():
+        return uri
+    sep = '&' if '?' in uri else '?'
+    return f'{uri}{sep}maxPoolSize={max_pool_size}'
+
+
+def _create_launchpad(location, max_pool_size):
+    """Create a `LaunchPad` with a connection pool of the given size"""
+    if location is None:
+        return LaunchPad(mongoclient_kwargs={'maxPoolSize': max_pool_size})
+    if is_uri(location):
+        # Connection options of the URI mode can only be passed in the URI
+        return LaunchPad(host=_uri_with_pool_size(location, max_pool_size),
+                         uri_mode=True)
+    config = loadfn(location)
+    if config.get('uri_mode'):
+        config['host'] = _uri_with_pool_size(config['host'], max_pool_size)
+    else:
+        config['mongoclient_kwargs'] = dict(
+            config.get('mongoclient_kwargs') or {})
+        config['mongoclient_kwargs'].setdefault('maxPoolSize', max_pool_size)
+    return LaunchPad.from_dict(config)
@@ -0,0 +1,194 @@
+"""
+Periodic maintenance of the AiiDA jobs in the LaunchPad
+"""
+from datetime import datetime, timedelta
+
+from aiida_fireworks_scheduler.common import RESERVED_CATEGORY
+from aiida_fireworks_scheduler.launchpads import LEASE_FIELD, LEASED_STATES
+
+AGING_STATES = ['WAITING', 'READY']
+# Details of the launches failed by the `CheckTimeoutTask`
+TIMEOUT_DETAIL = 'action.stored_data._exception._details.timeout'
+TIMEOUT_COMPUTER_DETAIL = 'action.stored_data._exception._details.computer_id'
+# Field marking the jobs recovered after their lease expired without being run again
+LOST_FIELD = 'aiida_lost'
+# Field marking the launches of the jobs requeued after a timeout
+REQUEUED_FIELD = 'aiida_requeued'
+
+
+def age_priorities(launchpad,
+                   interval,
+                   increment=10,
+                   max_levels=10,
+                   computer_id=None,
+                   now=None):
+    """
+    Raise the priority of the AiiDA jobs waiting to be run, so that jobs with low
+    priority are not starved by those with high priority arriving later.
+
+    The priority of a job is raised by ``increment`` for every ``interval`` seconds
+    since it was created, up to ``max_levels`` times. The number of increments
+    applied is recorded in ``spec._aiida_job_info.aging_level``, so that the update
+    can be repeated at any time.
+
+    :param launchpad: The LaunchPad to update.
+    :param interval: Seconds of waiting for each increment.
+    :param increment: Increment of the priority.
+    :param max_levels: Maximum number of increments.
+    :param computer_id: Only update the jobs of this computer, if given.
+    :param now: Current time (UTC), for testing.
+
+    :returns: The number of updates made.
+    """
+    now = now or datetime.utcnow()
+    nupdated = 0
+    # Lower levels go first so that a job may be raised by several levels at once
+    for level in range(1, max_levels + 1):
+        cutoff = now - timedelta(seconds=interval * level)
+        query = {
+            'spec._category': RESERVED_CATEGORY,
+            'state': {
+                '$in': AGING_STATES
+            },
+            # The time is stored as a string in ISO format
+            'created_on': {
+                '$lt': cutoff.isoformat()
+            },
+            'spec._aiida_job_info.aging_level':
+            None if level == 1 else level - 1,
+        }
+        if computer_id is not None:
+            query['spec._aiida_job_info.computer_id'] = computer_id
+        result = launchpad.fireworks.update_many(
+            query, {
+                '$inc': {
+                    'spec._priority': increment
+                },
+                '$set': {
+                    'spec._aiida_job_info.aging_level': level
+                }
+            })
+        nupdated += result.modified_count
+    return nupdated
+
+
+def recover_lost_jobs(launchpad, rerun=True, computer_id=None, now=None):
+    """
+    Recover the AiiDA jobs whose lease has expired, as their launcher is no longer
+    running, e.g. because the allocation was killed.
+
+    Each job is claimed by removing its lease before it is changed, so that it is
+    only recovered once even if several daemon workers run the maintenance at the
+    same time. The running launches of the jobs are marked as FIZZLED, and the jobs
+    are made ready to run again if ``rerun`` is set. Otherwise, they are marked with
+    ``LOST_FIELD`` so that they are reported to AiiDA as finished and failed. Only
+    the jobs run by a launcher with leases enabled are considered.
+
+    :param launchpad: The LaunchPad to update.
+    :param rerun: Run the jobs again, otherwise they are left FIZZLED.
+    :param computer_id: Only recover the jobs of this computer, if given.
+    :param now: Current time (UTC), for testing.
+
+    :returns: The ids of the Fireworks recovered.
+    """
+    now = now or datetime.utcnow()
+    query = {
+        'spec._category': RESERVED_CATEGORY,
+        'state': {
+            '$in': LEASED_STATES
+        },
+        LEASE_FIELD: {
+            '$lt': now
+        },
+    }
+    if computer_id is not None:
+        query['spec._aiida_job_info.computer_id'] = computer_id
+    fw_ids = []
+    while True:
+        fw_doc = launchpad.fireworks.find_one_and_update(
+            query, {'$unset': {
+                LEASE_FIELD: ''
+            }}, {
+                'fw_id': 1,
+                'state': 1
+            })
+        if fw_doc is None:
+            break
+        fw_id = fw_doc['fw_id']
+        for launch in launchpad.launches.find(
+            {
+                'fw_id': fw_id,
+                'state': {
+                    '$in': LEASED_STATES
+                }
+            }, {'launch_id': 1}):
+            launchpad.mark_fizzled(launch['launch_id'])
+        # Jobs reserved but never launched can always be run again
+        if rerun or fw_doc['state'] == 'RESERVED':
+            launchpad.rerun_fw(fw_id)
+        else:
+            launchpad.fireworks.update_one({'fw_id': fw_id},
+                                           {'$set': {
+                                               LOST_FIELD: True
+                                           }})
+        fw_ids.append(fw_id)
+    return fw_ids
+
+
+def requeue_timed_out_jobs(launchpad, factor=1.5, computer_id=None):
+    """
+    Requeue the AiiDA jobs that were killed at their walltime, with the walltime
+    raised by ``factor``.
+
+    Each launch failed by the `CheckTimeoutTask` is claimed by marking it as handled
+    before its job is changed, so that it is only requeued once even if several
+    daemon workers run the maintenance at the same time. Launches whose job is no
+    longer FIZZLED (e.g. it has been archived or run again) are only marked.
+
+    :param launchpad: The LaunchPad to update.
+    :param factor: Factor applied to the walltime of the jobs.
+    :param computer_id: Only requeue the jobs of this computer, if given.
+
+    :returns: The ids of the Fireworks requeued.
+    """
+    query = {
+        TIMEOUT_DETAIL: True,
+        'state': 'FIZZLED',
+        REQUEUED_FIELD: {
+            '$exists': False
+        }
+    }
+    if computer_id is not None:
+        query[TIMEOUT_COMPUTER_DETAIL] = computer_id
+    requeued = []
+    while True:
+        launch = launchpad.launches.find_one_and_update(
+            query, {'$set': {
+                REQUEUED_FIELD: True
+            }}, {
+                'launch_id': 1,
+                'fw_id': 1
+            })
+        if launch is None:
+            break
+        fw_doc = launchpad.fireworks.find_one(
+            {
+                'fw_id': launch['fw_id'],
+                'spec._category': RESERVED_CATEGORY,
+                'state': 'FIZZLED'
+            }, {'spec._aiida_job_info': 1})
+        if fw_doc is None:
+            continue
+        walltime = int(fw_doc['spec']['_aiida_job_info']['walltime'] * factor)
+        # The script reads the walltime from the spec when it is run
+        launchpad.fireworks.update_one({'fw_id': launch['fw_id']}, {
+            '$set': {
+                'spec._aiida_job_info.walltime': walltime,
+            },
+            '$inc': {
+                'spec._aiida_job_info.requeues': 1
+            }
+        })
+        launchpad.rerun_fw(launch['fw_id'])
+        requeued.append(launch['fw_id'])
+    return requeued
@@ -0,0 +1,267 @@
+"""
+Placement of concurrently running AiiDA jobs within an allocation
+
+When ``arlaunch multi`` runs several jobs side by side, each job script acquires
+either a disjoint set of cores on the node, or a share of the nodes of a multi-node
+allocation, from a state file shared by the rockets. The allocations are keyed by
+the PID of the job script, and those of processes no longer alive are released
+automatically.
+
+The module is called by the job scripts as::
+
+    python -m aiida_fireworks_scheduler.placement acquire <state_file> <ncpus> <pid>
+    python -m aiida_fireworks_scheduler.placement acquire-nodes <state_file> <nodefile> <ppn> <nprocs> <pid> <hostfile>
+    python -m aiida_fireworks_scheduler.placement release <state_file> <pid>
+
+It must not import aiida as it runs on the remote computer.
+"""
+import fcntl
+import json
+import math
+import os
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+# Environment variable of the state file, set by the launcher to enable the placement
+STATE_ENV = 'AIIDA_FW_CORE_STATE'
+# Environment variables of the node list and the slots per node for partitioning nodes
+NODEFILE_ENV = 'AIIDA_FW_NODEFILE'
+PPN_ENV = 'AIIDA_FW_PPN'
+
+
+def parse_cpu_list(text):
+    """
+    Parse a CPU list such as ``0-3,8`` into a list of integers
+    """
+    cpus = []
+    for token in text.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if '-' in token:
+            start, end = token.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(token))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """
+    Format a list of CPUs compactly, e.g. ``[0, 1, 2, 3, 8]`` gives ``0-3,8``
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(f'{start}-{end}' if end > start else str(start)
+                    for start, end in ranges)
+
+
+def available_cpus():
+    """Return the CPUs that this process is allowed to run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count()))
+
+
+def _is_alive(pid):
+    """Check if a process exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def locked_state(state_file):
+    """
+    Context manager giving the allocations in the state file under an exclusive lock.
+    The allocations of the processes no longer alive are removed and changes made
+    to the dictionary are written back.
+    """
+    with open(state_file, 'a+') as fhandle:
+        fcntl.flock(fhandle, fcntl.LOCK_EX)
+        try:
+            fhandle.seek(0)
+            content = fhandle.read()
+            state = json.loads(content) if content else {}
+            state = {
+                owner: value
+                for owner, value in state.items() if _is_alive(int(owner))
+            }
+            yield state
+            fhandle.seek(0)
+            fhandle.truncate()
+            json.dump(state, fhandle)
+            fhandle.flush()
+        finally:
+            fcntl.flock(fhandle, fcntl.LOCK_UN)
+
+
+def _pick(free, ncpus):
+    """
+    Pick ``ncpus`` from the sorted free CPUs, preferring a contiguous block
+    """
+    for idx in range(len(free) - ncpus + 1):
+        if free[idx + ncpus - 1] - free[idx] == ncpus - 1:
+            return free[idx:idx + ncpus]
+    return free[:ncpus]
+
+
+def acquire_cpus(state_file, ncpus, owner, cpus=None):
+    """
+    Acquire a set of CPUs not used by other jobs
+
+    :param state_file: Path to the state file shared by the jobs on the node.
+    :param ncpus: Number of CPUs to acquire.
+    :param owner: PID of the process holding the CPUs.
+    :param cpus: The CPUs to allocate from, default to those available to this process.
+
+    :returns: A list of the CPUs acquired, or None if not enough of them are free.
+    """
+    cpus = available_cpus() if cpus is None else sorted(cpus)
+    with locked_state(state_file) as state:
+        used = {
+            cpu
+            for value in state.values() for cpu in value.get('cpus', [])
+        }
+        free = [cpu for cpu in cpus if cpu not in used]
+        if ncpus <= 0 or ncpus > len(free):
+            return None
+        picked = _pick(free, ncpus)
+        state[str(owner)] = {'cpus': picked}
+    return picked
+
+
+def read_nodefile(nodefile):
+    """Read the unique nodes from a node file, keeping their order"""
+    nodes = []
+    with open(nodefile) as fhandle:
+        for line in fhandle:
+            node = line.strip()
+            if node and node not in nodes:
+                nodes.append(node)
+    return nodes
+
+
+def _pick_slots(free, ppn, nprocs):
+    """
+    Pick the slots for ``nprocs`` processes from the free slots of each node.
+    Jobs fitting in a node are packed to the node with the fewest free slots, larger
+    jobs take whole nodes.
+    """
+    if nprocs <= ppn:
+        candidates = [(nfree, node) for node, nfree in free.items()
+                      if nfree >= nprocs]
+        if not candidates:
+            return None
+        return [(min(candidates, key=lambda x: x[0])[1], nprocs)]
+
+    nnodes = math.ceil(nprocs / ppn)
+    empty = [node for node, nfree in free.items() if nfree == ppn]
+    if len(empty) < nnodes:
+        return None
+    slots = [(node, ppn) for node in empty[:nnodes]]
+    slots[-1] = (slots[-1][0], nprocs - ppn * (nnodes - 1))
+    return slots
+
+
+def acquire_slots(state_file, nodes, ppn, nprocs, owner):
+    """
+    Acquire the slots on the nodes of the allocation not used by other jobs
+
+    :param state_file: Path to the state file shared by the jobs.
+    :param nodes: A list of the nodes of the allocation.
+    :param ppn: Number of slots per node.
+    :param nprocs: Number of slots to acquire.
+    :param owner: PID of the process holding the slots.
+
+    :returns: A list of tuples of the node and the number of slots acquired on it,
+      or None if not enough of them are free.
+    """
+    with locked_state(state_file) as state:
+        free = {node: ppn for node in nodes}
+        for value in state.values():
+            for node, nslots in value.get('slots', {}).items():
+                if node in free:
+                    free[node] -= nslots
+        picked = _pick_slots(free, ppn, nprocs) if nprocs > 0 else None
+        if picked is None:
+            return None
+        state[str(owner)] = {'slots': dict(picked)}
+    return picked
+
+
+def write_hostfile(hostfile, slots):
+    """Write a host file with one line per slot, as accepted by most MPI launchers"""
+    with open(hostfile, 'w') as fhandle:
+        for node, nslots in slots:
+            for _ in range(nslots):
+                fhandle.write(node + '\n')
+
+
+def release(state_file, owner):
+    """Release the resources held by a process"""
+    with locked_state(state_file) as state:
+        state.pop(str(owner), None)
+
+
+def main(argv=None):
+    """Entry point for the job scripts"""
+    parser = ArgumentParser(
+        description='Placement of AiiDA jobs running concurrently')
+    subparsers = parser.add_subparsers(dest='command')
+    acquire_parser = subparsers.add_parser('acquire',
+                                           help='acquire CPUs for a job')
+    acquire_parser.add_argument('state_file')
+    acquire_parser.add_argument('ncpus', type=int)
+    acquire_parser.add_argument('owner', type=int)
+    nodes_parser = subparsers.add_parser(
+        'acquire-nodes',
+        help='acquire slots on the nodes of the allocation for a job')
+    nodes_parser.add_argument('state_file')
+    nodes_parser.add_argument('nodefile')
+    nodes_parser.add_argument('ppn', type=int)
+    nodes_parser.add_argument('nprocs', type=int)
+    nodes_parser.add_argument('owner', type=int)
+    nodes_parser.add_argument('hostfile')
+    release_parser = subparsers.add_parser(
+        'release', help='release the resources of a job')
+    release_parser.add_argument('state_file')
+    release_parser.add_argument('owner', type=int)
+
+    args = parser.parse_args(argv)
+    if args.command == 'acquire':
+        cpus = acquire_cpus(args.state_file, args.ncpus, args.owner)
+        if cpus is None:
+            sys.stderr.write(
+                f'Not enough free CPUs for {args.ncpus} processes, the job is not pinned\n'
+            )
+        else:
+            print(format_cpu_list(cpus))
+    elif args.command == 'acquire-nodes':
+        slots = acquire_slots(args.state_file, read_nodefile(args.nodefile),
+                              args.ppn, args.nprocs, args.owner)
+        if slots is None:
+            sys.stderr.write(
+                f'Not enough free slots for {args.nprocs} processes, the job uses all nodes\n'
+            )
+        else:
+            write_hostfile(args.hostfile, slots)
+            print(','.join(node for node, _ in slots))
+    elif args.command == 'release':
+        release(args.state_file, args.owner)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
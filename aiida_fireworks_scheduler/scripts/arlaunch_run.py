@@ -2,18 +2,22 @@
 A runnable script to launch a single Rocket (a command-line interface to rocket_launcher.py)
 Modify from the original rlaunch.py script in Fireworks package
 """
+import atexit
 import os
+import shutil
 import signal
 import sys
+import tempfile
 from argparse import ArgumentParser
 
 from fireworks.fw_config import LAUNCHPAD_LOC, CONFIG_FILE_DIR
-from fireworks.core.launchpad import LaunchPad
 from fireworks.core.rocket_launcher import rapidfire, launch_rocket
 from fireworks.utilities.fw_utilities import get_my_host, get_my_ip, get_fw_logger
 from fireworks.features.multi_launcher import launch_multiprocess
 
 from aiida_fireworks_scheduler.fworker import AiiDAFWorker
+from aiida_fireworks_scheduler.launchpads import AiiDALaunchPad, explain_checkout
+from aiida_fireworks_scheduler.placement import STATE_ENV, NODEFILE_ENV, PPN_ENV
 
 #pylint: disable=too-many-statements,line-too-long,import-outside-toplevel
 
@@ -42,6 +46,10 @@ def arlaunch():
         help='launch multiple Rockets (loop until all FireWorks complete)')
     multi_parser = subparsers.add_parser(
         'multi', help='launches multiple Rockets simultaneously')
+    subparsers.add_parser(
+        'explain',
+        help='explain the queries selecting the jobs for the worker, without '
+        'running any')
 
     single_parser.add_argument('-f',
                                '--fw_id',
@@ -102,18 +110,28 @@ def arlaunch():
         '--nodefile',
         help='nodefile name or environment variable name '
         'containing the node file name (for populating'
-        ' FWData only)',
+        ' FWData, or for --partition_nodes)',
         default=None,
         type=str)
     multi_parser.add_argument(
         '--ppn',
-        help='processors per node (for populating FWData only)',
+        help='processors per node (for populating FWData, or for '
+        '--partition_nodes)',
         default=1,
         type=int)
     multi_parser.add_argument('--exclude_current_node',
                               help="Don't use the script launching node"
                               "as compute node",
                               action="store_true")
+    multi_parser.add_argument(
+        '--pin_cores',
+        help="Pin the concurrently running AiiDA jobs to disjoint sets of cores",
+        action="store_true")
+    multi_parser.add_argument(
+        '--partition_nodes',
+        help="Split the nodes in the nodefile between the concurrently running "
+        "AiiDA jobs, with --ppn slots per node",
+        action="store_true")
     multi_parser.add_argument(
         '--local_redirect',
         help="Redirect stdout and stderr to the launch directory",
@@ -132,6 +150,13 @@ def arlaunch():
                         '(used if -l, -w unspecified)',
                         default=CONFIG_FILE_DIR)
 
+    parser.add_argument(
+        '--lease',
+        help='hold a lease of this many seconds on the running AiiDA jobs, '
+        'renewed while they run, so that they can be recovered if the launcher '
+        'dies (default 0 is no lease)',
+        default=0,
+        type=int)
     parser.add_argument('--loglvl',
                         help='level to print log messages',
                         default='INFO')
@@ -166,11 +191,34 @@ def arlaunch():
     if args.command == 'singleshot' and args.offline:
         launchpad = None
     else:
-        launchpad = LaunchPad.from_file(
-            args.launchpad_file) if args.launchpad_file else LaunchPad(
+        launchpad = AiiDALaunchPad.from_file(
+            args.launchpad_file) if args.launchpad_file else AiiDALaunchPad(
                 strm_lvl=args.loglvl)
 
     fworker = AiiDAFWorker.from_file(args.fworker_file)
+    if launchpad is not None:
+        launchpad.lease_seconds = args.lease or None
+        fworker.attach_launchpad(launchpad)
+    # Settings of the worker passed to the AiiDA jobs, with a directory private to
+    # this launcher removed when it exits
+    private_dir = None
+    if fworker.cache_login_env and args.command != 'explain':
+        private_dir = tempfile.mkdtemp(prefix='aiida-fw-')
+        atexit.register(shutil.rmtree, private_dir, ignore_errors=True)
+    os.environ.update(fworker.get_runtime_env(private_dir))
+    # Interpreter used by the job scripts for the placement of the jobs
+    os.environ['AIIDA_FW_PYTHON'] = sys.executable
+
+    if args.command == 'explain':
+        for idx, summary in enumerate(
+                explain_checkout(launchpad, fworker.query)):
+            print(f"Query {idx}: {summary['query']}")
+            print(f"  indexes: {', '.join(map(str, summary['indexes']))}")
+            print(f"  keys examined: {summary['keys_examined']}, "
+                  f"documents examined: {summary['docs_examined']}, "
+                  f"returned: {summary['returned']}, "
+                  f"time: {summary['time_ms']} ms")
+        return
 
     # prime addr lookups
     _log = get_fw_logger("rlaunch", stream_level="INFO")
@@ -197,17 +245,45 @@ def arlaunch():
                 total_node_list = [
                     line.strip() for line in fhandle.readlines()
                 ]
-        launch_multiprocess(launchpad,
-                            fworker,
-                            args.loglvl,
-                            args.nlaunches,
-                            args.num_jobs,
-                            args.sleep,
-                            total_node_list,
-                            args.ppn,
-                            timeout=args.timeout,
-                            exclude_current_node=args.exclude_current_node,
-                            local_redirect=args.local_redirect)
+        if args.partition_nodes and not total_node_list:
+            parser.error('--partition_nodes requires a non-empty --nodefile')
+        # Files shared by the jobs for their placement, created with private
+        # permissions under unpredictable names
+        placement_files = []
+        if args.pin_cores or args.partition_nodes:
+            fdesc, os.environ[STATE_ENV] = tempfile.mkstemp(
+                prefix='aiida-fw-placement-', suffix='.json')
+            os.close(fdesc)
+            placement_files.append(os.environ[STATE_ENV])
+        if args.partition_nodes:
+            # The nodes used by the jobs, written to a separate file as the current
+            # node may be excluded
+            nodes = [
+                node for node in total_node_list if not (
+                    args.exclude_current_node and node == get_my_host())
+            ]
+            fdesc, os.environ[NODEFILE_ENV] = tempfile.mkstemp(
+                prefix='aiida-fw-nodes-')
+            placement_files.append(os.environ[NODEFILE_ENV])
+            os.environ[PPN_ENV] = str(args.ppn)
+            with os.fdopen(fdesc, 'w') as fhandle:
+                fhandle.write('\n'.join(nodes) + '\n')
+        try:
+            launch_multiprocess(launchpad,
+                                fworker,
+                                args.loglvl,
+                                args.nlaunches,
+                                args.num_jobs,
+                                args.sleep,
+                                total_node_list,
+                                args.ppn,
+                                timeout=args.timeout,
+                                exclude_current_node=args.exclude_current_node,
+                                local_redirect=args.local_redirect)
+        finally:
+            for fname in placement_files:
+                if os.path.isfile(fname):
+                    os.remove(fname)
     else:
         launch_rocket(launchpad,
                       fworker,
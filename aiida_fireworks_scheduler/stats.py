@@ -0,0 +1,114 @@
+"""
+Statistics of the AiiDA jobs in the LaunchPad
+
+The jobs are counted with a single aggregation, grouped by computer, user, number of
+MPI processes, walltime bucket and state, which helps to choose the size of the
+allocations running ``arlaunch``.
+"""
+from datetime import datetime
+
+from aiida_fireworks_scheduler.common import ACTIVE_STATES, RESERVED_CATEGORY, parse_time
+
+# Upper bounds of the walltime buckets in seconds
+WALLTIME_BUCKETS = [3600, 4 * 3600, 12 * 3600, 24 * 3600, 48 * 3600]
+# Fields of the rows of the statistics
+STATS_FIELDS = [
+    'computer_id', 'username', 'mpinp', 'walltime_bucket', 'state', 'count',
+    'core_seconds', 'oldest_age'
+]
+
+
+def get_stats_pipeline(states=None,
+                       computer_id=None,
+                       buckets=WALLTIME_BUCKETS):
+    """
+    Aggregation pipeline for the statistics of the AiiDA jobs
+
+    :param states: States of the jobs to include, default to the active ones.
+    :param computer_id: Only include the jobs of this computer, if given.
+    :param buckets: Upper bounds of the walltime buckets in seconds.
+    """
+    match = {
+        'spec._category': RESERVED_CATEGORY,
+        'state': {
+            '$in': list(states or ACTIVE_STATES)
+        }
+    }
+    if computer_id is not None:
+        match['spec._aiida_job_info.computer_id'] = computer_id
+    walltime = '$spec._aiida_job_info.walltime'
+    return [
+        {
+            '$match': match
+        },
+        {
+            '$group': {
+                '_id': {
+                    'computer_id': '$spec._aiida_job_info.computer_id',
+                    'username': '$spec._aiida_job_info.username',
+                    'mpinp': '$spec._aiida_job_info.mpinp',
+                    # The upper bound of the bucket, None above the last one
+                    'walltime_bucket': {
+                        '$switch': {
+                            'branches': [{
+                                'case': {
+                                    '$lte': [walltime, bound]
+                                },
+                                'then': bound
+                            } for bound in buckets],
+                            'default': None
+                        }
+                    },
+                    'state': '$state',
+                },
+                'count': {
+                    '$sum': 1
+                },
+                'core_seconds': {
+                    '$sum': {
+                        '$multiply': [walltime, '$spec._aiida_job_info.mpinp']
+                    }
+                },
+                'oldest': {
+                    '$min': '$created_on'
+                },
+            }
+        },
+        {
+            '$sort': {
+                '_id.computer_id': 1,
+                '_id.username': 1,
+                '_id.mpinp': 1,
+                '_id.walltime_bucket': 1,
+                '_id.state': 1,
+            }
+        },
+    ]
+
+
+def get_stats(launchpad, states=None, computer_id=None, now=None):
+    """
+    Compute the statistics of the AiiDA jobs in the LaunchPad
+
+    :param launchpad: The LaunchPad to query.
+    :param states: States of the jobs to include, default to the active ones.
+    :param computer_id: Only include the jobs of this computer, if given.
+    :param now: Current time (UTC), for testing.
+
+    :returns: A list of dictionaries with the `STATS_FIELDS`. The walltime bucket is
+      its upper bound in seconds, and the age of the oldest job is in seconds.
+    """
+    now = now or datetime.utcnow()
+    rows = []
+    for doc in launchpad.fireworks.aggregate(
+            get_stats_pipeline(states, computer_id)):
+        row = dict(doc['_id'])
+        row['count'] = doc['count']
+        row['core_seconds'] = doc['core_seconds']
+        try:
+            oldest = parse_time(doc['oldest'])
+            row['oldest_age'] = int((now - oldest).total_seconds())
+        except (TypeError, ValueError):
+            row['oldest_age'] = None
+        rows.append(row)
+    return rows
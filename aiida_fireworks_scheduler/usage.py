@@ -0,0 +1,160 @@
+"""
+Sampling the resource usage of a job
+
+The job script starts the sampler in the background as::
+
+    python -m aiida_fireworks_scheduler.usage <pid> <interval> <output>
+
+It reads the CPU time, resident memory and I/O counters of the process tree of
+``pid`` from ``/proc`` every ``interval`` seconds, and writes a summary as JSON to
+``output`` when the process has finished. The counters of processes that exit
+between two samples are taken from their last sample.
+
+It must not import aiida as it runs on the remote computer.
+"""
+import json
+import os
+import sys
+import time
+
+# Environment variable of the sampling interval, set by the launcher to enable the sampling
+INTERVAL_ENV = 'AIIDA_FW_USAGE_INTERVAL'
+USAGE_FILE = '_fw_usage.json'
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def _read_stat(pid):
+    """Return the parent PID and the CPU time in seconds of a process"""
+    with open(f'/proc/{pid}/stat') as fhandle:
+        content = fhandle.read()
+    # The command name may contain spaces, the rest of the fields follow the last ')'
+    fields = content[content.rindex(')') + 2:].split()
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def _is_running(pid):
+    """Check if a process exists and has not finished, e.g. as a zombie"""
+    try:
+        with open(f'/proc/{pid}/stat') as fhandle:
+            content = fhandle.read()
+    except OSError:
+        return False
+    return content[content.rindex(')') + 2] != 'Z'
+
+
+def _read_rss(pid):
+    """Return the resident memory of a process in kB"""
+    with open(f'/proc/{pid}/status') as fhandle:
+        for line in fhandle:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _read_io(pid):
+    """Return the bytes read from and written to the storage by a process"""
+    counters = {}
+    try:
+        with open(f'/proc/{pid}/io') as fhandle:
+            for line in fhandle:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        return 0, 0
+    return counters.get('read_bytes', 0), counters.get('write_bytes', 0)
+
+
+def sample_tree(root):
+    """
+    Sample the process tree of ``root``
+
+    :returns: A dictionary of the PID and a tuple of the CPU time, resident
+      memory and I/O counters of each process in the tree.
+    """
+    stats = {}
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            parents[int(entry)], cpu = _read_stat(entry)
+            stats[int(entry)] = cpu
+        except (OSError, ValueError, IndexError):
+            continue
+
+    tree = {root} if root in stats else set()
+    # Walk down the tree until no new process is found
+    nfound = -1
+    while nfound != len(tree):
+        nfound = len(tree)
+        tree.update(pid for pid, ppid in parents.items() if ppid in tree)
+
+    samples = {}
+    for pid in tree:
+        try:
+            samples[pid] = (stats[pid], _read_rss(pid)) + _read_io(pid)
+        except OSError:
+            continue
+    return samples
+
+
+class UsageSampler:
+    """Accumulate the usage of a process tree over the samples"""
+    def __init__(self, root):
+        self.root = root
+        self.start = time.time()
+        self.last = {}
+        self.peak_rss = 0
+        self.max_procs = 0
+        self.nsamples = 0
+
+    def sample(self):
+        """Take a sample of the process tree"""
+        samples = sample_tree(self.root)
+        self.last.update(samples)
+        self.peak_rss = max(self.peak_rss,
+                            sum(value[1] for value in samples.values()))
+        self.max_procs = max(self.max_procs, len(samples))
+        self.nsamples += 1
+
+    def summary(self):
+        """Summary of the usage"""
+        wall = time.time() - self.start
+        cpu = sum(value[0] for value in self.last.values())
+        return {
+            'wall_seconds': round(wall, 1),
+            'cpu_seconds': round(cpu, 1),
+            'mean_cpus': round(cpu / wall, 2) if wall > 0 else 0,
+            'peak_rss_mb': round(self.peak_rss / 1024, 1),
+            'read_mb': round(
+                sum(value[2] for value in self.last.values()) / 1024**2, 1),
+            'write_mb': round(
+                sum(value[3] for value in self.last.values()) / 1024**2, 1),
+            'max_procs': self.max_procs,
+            'nsamples': self.nsamples,
+        }
+
+
+def monitor(root, interval, output):
+    """
+    Sample the process tree of ``root`` until it finishes and write the summary
+
+    :param root: PID of the process to monitor.
+    :param interval: Seconds between the samples.
+    :param output: Path of the JSON file to write.
+    """
+    sampler = UsageSampler(root)
+    next_sample = time.time()
+    while _is_running(root):
+        if time.time() >= next_sample:
+            sampler.sample()
+            next_sample += interval
+        # Check for the end of the job more often than sampling
+        time.sleep(min(1, interval))
+    with open(output, 'w') as fhandle:
+        json.dump(sampler.summary(), fhandle)
+
+
+if __name__ == '__main__':
+    monitor(int(sys.argv[1]), float(sys.argv[2]), sys.argv[3])
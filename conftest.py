@@ -7,6 +7,8 @@ import pytest
 from fireworks.core.launchpad import LaunchPad
 from fireworks import fw_config
 
+from aiida_fireworks_scheduler.jobs import AiiDAJobFirework
+
 # pylint: disable=invalid-name, redefined-outer-name
 
 pytest_plugins = ['aiida.manage.tests.pytest_fixtures']
@@ -42,3 +44,31 @@ def clean_launchpad(launchpad):
     """Get a launchpad in clean state"""
     launchpad.reset(password=None, require_password=False)
     return launchpad
+
+
+@pytest.fixture
+def make_job():
+    """
+    Get a function making the Firework of an AiiDA job
+
+    The job runs in ``/tmp/aiida-test-<idx>``, or ``/tmp/aiida-test`` if no index
+    is given, and the other arguments are passed to `AiiDAJobFirework`.
+    """
+    def _make_job(idx=None,
+                  computer_id='localhost',
+                  username='user',
+                  **kwargs):
+        suffix = '' if idx is None else f'-{idx}'
+        options = {
+            'walltime': 1800,
+            'mpinp': 2,
+            'stdout_fname': '_scheduler-stdout.txt',
+            'stderr_fname': '_scheduler-stderr.txt',
+        }
+        options.update(kwargs)
+        return AiiDAJobFirework(computer_id, username,
+                                f'/tmp/aiida-test{suffix}',
+                                f'aiida{suffix or "-1"}', '_aiidasubmit.sh',
+                                **options)
+
+    return _make_job
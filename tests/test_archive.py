@@ -0,0 +1,92 @@
+"""
+Tests for archiving finished jobs
+"""
+import gzip
+
+import pytest
+
+from aiida_fireworks_scheduler.archive import (get_archive_query,
+                                               estimate_archive, archive_jobs,
+                                               ARCHIVE_SUFFIX)
+from aiida_fireworks_scheduler.grouping import add_grouped_firework
+
+# pylint: disable=redefined-outer-name
+
+
+@pytest.fixture
+def finished_jobs(clean_launchpad, make_job):
+    """Add three jobs and mark two of them as COMPLETED"""
+    fw_ids = []
+    for idx in range(3):
+        job = make_job(idx)
+        fw_ids.extend(clean_launchpad.add_wf(job).values())
+    clean_launchpad.fireworks.update_many({'fw_id': {
+        '$in': fw_ids[:2]
+    }}, {'$set': {
+        'state': 'COMPLETED'
+    }})
+    return fw_ids
+
+
+def test_archive_collections(finished_jobs, clean_launchpad):
+    """Test moving jobs to the archive collections"""
+    lpad = clean_launchpad
+    query = get_archive_query()
+    assert estimate_archive(lpad, query)['fireworks']['count'] == 2
+
+    totals = archive_jobs(lpad, query, batch_size=1)
+    assert totals['fireworks'] == 2
+    assert totals['workflows'] == 2
+    assert lpad.get_fw_ids({}) == [finished_jobs[2]]
+    assert lpad.db['fireworks' + ARCHIVE_SUFFIX].count_documents({}) == 2
+    assert lpad.db['workflows' + ARCHIVE_SUFFIX].count_documents({}) == 2
+    assert lpad.workflows.count_documents({}) == 1
+
+
+def test_archive_files(finished_jobs, clean_launchpad, tmp_path):
+    """Test moving jobs to compressed JSONL files"""
+    lpad = clean_launchpad
+    archive_jobs(lpad, get_archive_query(), output_dir=str(tmp_path))
+
+    with gzip.open(str(tmp_path / 'fireworks.jsonl.gz'), 'rt') as handle:
+        assert len(handle.readlines()) == 2
+    assert lpad.get_fw_ids({}) == [finished_jobs[2]]
+
+
+def test_archive_grouped(clean_launchpad, make_job):
+    """Test archiving some of the jobs of a group"""
+    lpad = clean_launchpad
+    fw_ids = []
+    for idx in range(3):
+        job = make_job(idx)
+        fw_ids.append(add_grouped_firework(lpad, job, 60))
+    lpad.fireworks.update_many({'fw_id': {
+        '$in': fw_ids[:2]
+    }}, {'$set': {
+        'state': 'COMPLETED'
+    }})
+
+    query = get_archive_query()
+    estimate = estimate_archive(lpad, query)
+    assert estimate['fireworks']['count'] == 2
+    # The group has a job left
+    assert estimate['workflows']['count'] == 0
+
+    totals = archive_jobs(lpad, query)
+    assert totals['workflows'] == 0
+    wf_doc = lpad.workflows.find_one({})
+    assert wf_doc['nodes'] == [fw_ids[2]]
+    assert list(wf_doc['fw_states']) == [str(fw_ids[2])]
+    assert list(wf_doc['links']) == [str(fw_ids[2])]
+    assert wf_doc['state'] == 'READY'
+    assert 'locked' not in wf_doc
+    # The workflow can still be loaded
+    assert lpad.get_wf_by_fw_id(fw_ids[2]).fws[0].fw_id == fw_ids[2]
+
+    lpad.fireworks.update_one({'fw_id': fw_ids[2]},
+                              {'$set': {
+                                  'state': 'COMPLETED'
+                              }})
+    assert estimate_archive(lpad, query)['workflows']['count'] == 1
+    assert archive_jobs(lpad, query)['workflows'] == 1
+    assert lpad.workflows.count_documents({}) == 0
@@ -8,7 +8,7 @@ import shutil
 import pytest
 
 from click.testing import CliRunner
-from aiida_fireworks_scheduler.cmdline import generate_worker, duplicate_fe
+from aiida_fireworks_scheduler.cmdline import generate_worker, duplicate_fe, configure_computer
 
 # pylint: disable=import-outside-toplevel,no-member,redefined-outer-name
 LOCALHOST_NAME = 'localhost-test'
@@ -164,3 +164,32 @@ def test_worker(cmd_test_env):
         assert worker.computer_id == "localhost"
         assert worker.username == DEFAULT_USERNAME
         assert worker.mpinp == 4
+
+
+def test_configure_computer(cmd_test_env):
+    """Test storing the scheduler settings in the computer"""
+    from aiida_fireworks_scheduler.fwscheduler import get_computer_settings
+    runner = CliRunner()
+    _ = cmd_test_env
+
+    runner.invoke(duplicate_fe, ["-Y", "localhost"], catch_exceptions=False)
+    runner.invoke(configure_computer, [
+        '-Y', 'localhost-fw', '--launchpad', 'mongodb://localhost/fw',
+        '--max-pool-size', '5'
+    ],
+                  catch_exceptions=False)
+    settings = get_computer_settings('localhost')
+    assert settings['launchpad'] == 'mongodb://localhost/fw'
+    assert settings['max_pool_size'] == 5
+
+    runner.invoke(configure_computer,
+                  ['-Y', 'localhost-fw', '--unset', 'max-pool-size'],
+                  catch_exceptions=False)
+    assert 'max_pool_size' not in get_computer_settings('localhost')
+
+    # MongoDB does not accept a maximum staleness below 90 seconds
+    result = runner.invoke(
+        configure_computer,
+        ['-Y', 'localhost-fw', '--max-staleness', '30'])
+    assert result.exit_code != 0
+    assert 'max_staleness' not in get_computer_settings('localhost')
@@ -0,0 +1,57 @@
+"""
+Tests for the walltime estimator
+"""
+import pickle
+
+from aiida_fireworks_scheduler.estimator import WalltimeEstimator
+from aiida_fireworks_scheduler.fworker import AiiDAFWorker
+from aiida_fireworks_scheduler.launchpads import AiiDALaunchPad
+
+
+def test_walltime_estimator(clean_launchpad, make_job):
+    """Test estimating the runtime from the completed jobs"""
+    lpad = clean_launchpad
+    fw_ids = []
+    for idx in range(12):
+        job = make_job(idx, walltime=1000)
+        fw_ids.extend(lpad.add_wf(job).values())
+    # Ten jobs completed using 10% to 19% of the requested walltime
+    for idx, fw_id in enumerate(fw_ids[:10]):
+        lpad.fireworks.update_one({'fw_id': fw_id},
+                                  {'$set': {
+                                      'state': 'COMPLETED'
+                                  }})
+        lpad.launches.insert_one({
+            'launch_id': idx,
+            'fw_id': fw_id,
+            'state': 'COMPLETED',
+            'runtime_secs': 100 + 10 * idx
+        })
+
+    estimator = WalltimeEstimator('localhost', 'user', lpad, min_samples=5)
+    assert len(estimator.get_samples()) == 10
+    assert estimator.ratio == 0.19 * 1.2
+    # Not enough samples
+    assert WalltimeEstimator('localhost', 'user', lpad).ratio == 1.0
+
+    worker = AiiDAFWorker('localhost',
+                          mpinp=2,
+                          username='user',
+                          walltime_estimator={'min_samples': 5})
+    limit = worker.query['$or'][0]['spec._aiida_job_info.walltime']['$lt']
+    worker.attach_launchpad(lpad)
+    assert worker.query['$or'][0]['spec._aiida_job_info.walltime'][
+        '$lt'] == limit / (0.19 * 1.2)
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    assert worker2.estimator.min_samples == 5
+
+    # With arlaunch multi, the LaunchPad receives pickled copies of the worker
+    alpad = AiiDALaunchPad.from_dict(lpad.to_dict())
+    copy = pickle.loads(pickle.dumps(worker))
+    assert copy.estimator.launchpad is None
+    assert alpad.run_exists(copy)
+    kept = alpad.keep_worker(pickle.loads(pickle.dumps(worker)))
+    assert kept is copy
+    assert kept.estimator.launchpad is alpad
+    assert kept.query['$or'][0]['spec._aiida_job_info.walltime'][
+        '$lt'] == limit / (0.19 * 1.2)
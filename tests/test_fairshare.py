@@ -0,0 +1,57 @@
+"""
+Tests for the fair share between users
+"""
+from datetime import datetime, timedelta
+import pickle
+
+from aiida_fireworks_scheduler.fworker import AiiDAFWorker
+from aiida_fireworks_scheduler.launchpads import AiiDALaunchPad
+
+
+def add_job(lpad, make_job, username, priority):
+    """Add a job of a user"""
+    job = make_job(username, username=username, priority=priority)
+    return list(lpad.add_wf(job).values())[0]
+
+
+def test_fair_share(clean_launchpad, make_job):
+    """Test running the jobs of the user with less recent usage first"""
+    lpad = AiiDALaunchPad.from_dict(clean_launchpad.to_dict())
+    alice_id = add_job(lpad, make_job, 'alice', 200)
+    bob_id = add_job(lpad, make_job, 'bob', 100)
+    # Alice has used two cores for an hour
+    now = datetime.utcnow()
+    lpad.launches.insert_one({
+        'launch_id': 100,
+        'fw_id': alice_id,
+        'state': 'COMPLETED',
+        'time_start': (now - timedelta(hours=1)).isoformat(),
+        'time_end': now.isoformat()
+    })
+
+    worker = AiiDAFWorker('localhost',
+                          mpinp=2,
+                          username=['alice', 'bob'],
+                          fair_share=True)
+    worker.attach_launchpad(lpad)
+    usage = worker.fair_share.get_usage()
+    assert round(usage['alice']) == 7200
+    assert usage['bob'] == 0
+    assert worker.fair_share.usernames_in_order == ['bob', 'alice']
+
+    # With arlaunch multi, the LaunchPad receives pickled copies of the worker
+    copy = pickle.loads(pickle.dumps(worker))
+    assert copy.fair_share.launchpad is None
+    fw, _ = lpad.checkout_fw(copy, '/tmp/aiida-test-bob')
+    assert fw.fw_id == bob_id
+    assert lpad.keep_worker(copy).fair_share.usernames_in_order == [
+        'bob', 'alice'
+    ]
+    assert lpad._get_a_fw_to_run(worker.query).fw_id == alice_id  # pylint: disable=protected-access
+
+    # Without fair share, the jobs of all users are selected by priority
+    worker = AiiDAFWorker('localhost', mpinp=2, username=['alice', 'bob'])
+    assert worker.fair_share is None
+    assert worker.query['$or'][0]['spec._aiida_job_info.username'] == {
+        '$in': ['alice', 'bob']
+    }
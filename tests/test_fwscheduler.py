@@ -6,6 +6,7 @@ from pathlib import Path
 import contextlib
 import os
 import shutil
+import time
 
 import pytest
 
@@ -13,10 +14,12 @@ from fireworks.core.rocket_launcher import launch_rocket
 
 from aiida.common.extendeddicts import AttributeDict
 from aiida.schedulers.datastructures import JobInfo, JobState
-from aiida.schedulers import SchedulerParsingError
+from aiida.schedulers import SchedulerError, SchedulerParsingError
 
-from aiida_fireworks_scheduler.fwscheduler import FwJobResource, FwScheduler, parse_sge_script
-from aiida_fireworks_scheduler.jobs import AiiDAJobFirework
+from aiida_fireworks_scheduler.fwscheduler import FwJobResource, FwScheduler, parse_sge_script, \
+    _LAST_MAINTENANCE
+from aiida_fireworks_scheduler.jobs import TIMEOUT_FILE
+from aiida_fireworks_scheduler.maintenance import requeue_timed_out_jobs
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIR = Path(TEST_DIR) / 'data'
@@ -33,56 +36,29 @@ def keep_cwd():
 
 
 @pytest.fixture
-def dummy_job(clean_launchpad):
+def dummy_job(clean_launchpad, make_job):
     """Create a dummy job"""
 
-    job = AiiDAJobFirework('localhost',
-                           'user',
-                           '/tmp/aiida-test',
-                           'aiida-1',
-                           '_aiidasubmit.sh',
-                           walltime=1800,
-                           mpinp=2,
-                           stdout_fname='_scheduler-stdout.txt',
-                           stderr_fname='_scheduler-stderr.txt')
+    job = make_job()
 
     job_id = clean_launchpad.add_wf(job)
     return job_id
 
 
 @pytest.fixture
-def dummy_job_with_env(clean_launchpad):
+def dummy_job_with_env(clean_launchpad, make_job):
     """Create a dummy job that keeps the environmental variables"""
-    job = AiiDAJobFirework(
-        'localhost',
-        'user',
-        '/tmp/aiida-test',
-        'aiida-1',
-        '_aiidasubmit.sh',
-        walltime=1800,
-        mpinp=2,
-        stdout_fname='_scheduler-stdout.txt',
-        stderr_fname='_scheduler-stderr.txt',
-        fresh_env=False,
-    )
+    job = make_job(fresh_env=False)
 
     job_id = clean_launchpad.add_wf(job)
     return job_id
 
 
 @pytest.fixture
-def short_job(clean_launchpad):
+def short_job(clean_launchpad, make_job):
     """Create a dummy job"""
 
-    job = AiiDAJobFirework('localhost',
-                           'user',
-                           '/tmp/aiida-test',
-                           'aiida-1',
-                           '_aiidasubmit.sh',
-                           walltime=2,
-                           mpinp=2,
-                           stdout_fname='_scheduler-stdout.txt',
-                           stderr_fname='_scheduler-stderr.txt')
+    job = make_job(walltime=2)
 
     job_id = clean_launchpad.add_wf(job)
     return job_id
@@ -178,6 +154,77 @@ def test_job_run_with_env(dummy_job_with_env, launchpad):
     shutil.rmtree(str(ldir))
 
 
+def test_job_run_staged(clean_launchpad, tmp_path, make_job):
+    """
+    Test running a job in a staging folder, the outputs should be copied back
+    """
+    lpad = clean_launchpad
+    job = make_job(stage_dir=str(tmp_path))
+    job_id = list(lpad.add_wf(job).values())[0]
+
+    ldir = Path('/tmp/aiida-test')
+    ldir.mkdir(parents=True, exist_ok=True)
+    (ldir / 'input').write_text('Foo')
+    (ldir / '_aiidasubmit.sh').write_text("cat input > bar; pwd > cwd")
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+
+    assert (ldir / 'bar').read_text() == 'Foo'
+    assert (ldir / 'cwd').read_text().startswith(str(tmp_path))
+    assert 'stage_out_seconds' in (ldir / '_fw_staging.txt').read_text()
+    # The staging folder is removed
+    assert not list(tmp_path.iterdir())
+    assert lpad.get_fw_dict_by_id(job_id)['state'] == 'COMPLETED'
+
+    # Clean up the tempdiretory
+    shutil.rmtree(str(ldir))
+
+    # The job runs in its working directory if it cannot be staged
+    job = make_job('unstaged', stage_dir=str(tmp_path / 'missing'))
+    job_id = list(lpad.add_wf(job).values())[0]
+    ldir = Path('/tmp/aiida-test-unstaged')
+    ldir.mkdir(parents=True, exist_ok=True)
+    (ldir / '_aiidasubmit.sh').write_text("pwd > cwd")
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+
+    assert (ldir / 'cwd').read_text().strip() == str(ldir)
+    assert not (ldir / '_fw_staging.txt').exists()
+    assert lpad.get_fw_dict_by_id(job_id)['state'] == 'COMPLETED'
+    shutil.rmtree(str(ldir))
+
+
+def test_job_run_env_cache(clean_launchpad, tmp_path, monkeypatch, make_job):
+    """
+    Test running jobs with a cached login environment
+    """
+    lpad = clean_launchpad
+    cache = tmp_path / 'env-cache'
+    monkeypatch.setenv('AIIDA_FW_ENV_CACHE', str(cache))
+    monkeypatch.setenv('AIIDA_FW_TEST_VAR', 'foo')
+
+    # Each job has its own working directory
+    for idx in range(3):
+        if idx == 2:
+            # A cache writable by others is not used
+            cache.write_text('export AIIDA_FW_TEST_VAR=bar\n')
+            cache.chmod(0o666)
+        ldir = Path(f'/tmp/aiida-test-{idx}')
+        ldir.mkdir(parents=True, exist_ok=True)
+        (ldir / '_aiidasubmit.sh').write_text("echo $AIIDA_FW_TEST_VAR > bar")
+        job = make_job(idx)
+        job_id = list(lpad.add_wf(job).values())[0]
+        with keep_cwd():
+            launch_rocket(lpad, fw_id=job_id)
+        assert lpad.get_fw_dict_by_id(job_id)['state'] == 'COMPLETED'
+        assert cache.is_file()
+        # The environment of the launcher is not passed to the job
+        assert (ldir / 'bar').read_text() == '\n'
+
+        # Clean up the tempdiretory
+        shutil.rmtree(str(ldir))
+
+
 def test_get_jobs(dummy_job, launchpad):
     """Test the get_jobs method"""
 
@@ -206,6 +253,48 @@ def test_get_jobs(dummy_job, launchpad):
     assert not jobs
 
 
+def test_get_jobs_states(dummy_job, launchpad):
+    """Test that get_jobs reports defused jobs and uses the computer index"""
+
+    fw_id = list(dummy_job.values())[0]
+    scheduler = FwScheduler(launchpad)
+    scheduler.set_transport(AttributeDict({'_machine': 'localhost'}))
+
+    launchpad.defuse_fw(fw_id)
+    jobs = scheduler.get_jobs(jobs=[str(fw_id)])
+    assert len(jobs) == 1
+    assert jobs[0].job_state == JobState.SUSPENDED
+
+    # Jobs on other computers are not listed
+    scheduler.set_transport(AttributeDict({'_machine': 'remote'}))
+    assert not scheduler.get_jobs()
+
+    index_keys = [[key for key, _ in index['key']]
+                  for index in launchpad.fireworks.index_information().values()]
+    assert ['spec._aiida_job_info.computer_id', 'state'] in index_keys
+
+
+def test_launchpad_timeout(dummy_job, launchpad):
+    """Test that the calls to the LaunchPad are given up after the timeout"""
+
+    fw_id = str(list(dummy_job.values())[0])
+    scheduler = FwScheduler(launchpad)
+    scheduler.set_transport(AttributeDict({'_machine': 'localhost'}))
+    scheduler._settings = {'launchpad_timeout': 1}  # pylint: disable=protected-access
+
+    # The calls are made in the thread pool
+    assert scheduler.get_jobs(as_dict=True)[fw_id].job_state == JobState.QUEUED
+    with pytest.raises(SchedulerError, match='did not reply'):
+        scheduler._run_blocking(time.sleep, 3)  # pylint: disable=protected-access
+    # No new calls are made until the one that timed out has finished
+    with pytest.raises(SchedulerError, match='still running'):
+        scheduler.kill(fw_id)
+    time.sleep(3)
+
+    assert scheduler.kill(fw_id)
+    assert launchpad.get_fw_ids(query={'state': 'DEFUSED'}) == [int(fw_id)]
+
+
 def test_parse_script():
     """Test parsing script"""
     options = parse_sge_script((Path(TEST_DIR) / 'data') / '_aiidasubmit.sh')
@@ -215,6 +304,7 @@ def test_parse_script():
     assert options['stderr_fname'] == '_scheduler-stderr.txt'
     assert options['mpinp'] == 24
     assert options['walltime'] == 8 * 3600
+    assert options['hold'] is False
 
     # Test raising error for incomplete script
     with pytest.raises(SchedulerParsingError):
@@ -279,6 +369,101 @@ def test_job_timeout(short_job, launchpad):
     fw_dict = lpad.get_fw_dict_by_id(job_id)
     assert fw_dict['state'] == 'COMPLETED'
     assert fw_dict['launches'][0]['action']['stored_data']['returncode'] == 12
+    assert fw_dict['launches'][0]['action']['stored_data']['timeout']
+
+    # Clean up the tempdiretory
+    shutil.rmtree(str(ldir))
+
+
+def test_job_timeout_requeue(clean_launchpad, make_job):
+    """Test requeuing a job killed at its walltime with a longer walltime"""
+    lpad = clean_launchpad
+    job = make_job(walltime=1, max_requeues=1)
+    job_id = list(lpad.add_wf(job).values())[0]
+    ldir = Path('/tmp/aiida-test')
+    ldir.mkdir(parents=True, exist_ok=True)
+    (ldir / '_aiidasubmit.sh').write_text("sleep 5 && touch foo")
+
+    # The launch fails, so the job is not reported as finished before it is requeued
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+    assert lpad.get_fw_dict_by_id(job_id)['state'] == 'FIZZLED'
+
+    assert requeue_timed_out_jobs(lpad, factor=5) == [job_id]
+    assert requeue_timed_out_jobs(lpad, factor=5) == []
+    fw_dict = lpad.get_fw_dict_by_id(job_id)
+    assert fw_dict['state'] == 'READY'
+    assert fw_dict['spec']['_aiida_job_info']['walltime'] == 5
+    assert fw_dict['spec']['_aiida_job_info']['requeues'] == 1
+
+    # The script is run with the raised walltime
+    (ldir / '_aiidasubmit.sh').write_text("sleep 1 && touch foo")
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+    fw_dict = lpad.get_fw_dict_by_id(job_id)
+    assert fw_dict['state'] == 'COMPLETED'
+    assert 'timeout' not in fw_dict['launches'][0]['action']['stored_data']
+
+    # No more requeues left, the timeout is recorded and reported to AiiDA
+    lpad.rerun_fw(job_id)
+    (ldir / '_aiidasubmit.sh').write_text("sleep 10 && touch foo")
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+    fw_dict = lpad.get_fw_dict_by_id(job_id)
+    assert fw_dict['state'] == 'COMPLETED'
+    assert fw_dict['launches'][0]['action']['stored_data']['timeout']
+    scheduler = FwScheduler(lpad)
+    detailed_job_info = scheduler.get_detailed_job_info(str(job_id))
+    assert scheduler.parse_output(detailed_job_info).status == 120
+
+    # Clean up the tempdiretory
+    shutil.rmtree(str(ldir))
+
+
+def test_job_failure_not_requeued(clean_launchpad, make_job):
+    """Test that a job exiting with an error is not taken as timed out"""
+    lpad = clean_launchpad
+    job = make_job(walltime=60, max_requeues=1)
+    job_id = list(lpad.add_wf(job).values())[0]
+    ldir = Path('/tmp/aiida-test')
+    ldir.mkdir(parents=True, exist_ok=True)
+    (ldir / '_aiidasubmit.sh').write_text("exit 1")
+
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+    fw_dict = lpad.get_fw_dict_by_id(job_id)
+    assert fw_dict['state'] == 'COMPLETED'
+    assert fw_dict['launches'][0]['action']['stored_data']['returncode'] == 13
+    assert not (ldir / TIMEOUT_FILE).exists()
+
+    # Clean up the tempdiretory
+    shutil.rmtree(str(ldir))
+
+
+def test_job_timeout_requeue_unset(clean_launchpad, make_job):
+    """
+    Test that the jobs submitted with max_requeues are requeued by the scheduler
+    even if the setting has been removed since
+    """
+    lpad = clean_launchpad
+    job = make_job(walltime=1, max_requeues=1)
+    job_id = list(lpad.add_wf(job).values())[0]
+    ldir = Path('/tmp/aiida-test')
+    ldir.mkdir(parents=True, exist_ok=True)
+    (ldir / '_aiidasubmit.sh').write_text("sleep 5 && touch foo")
+    with keep_cwd():
+        launch_rocket(lpad, fw_id=job_id)
+    assert lpad.get_fw_dict_by_id(job_id)['state'] == 'FIZZLED'
+
+    scheduler = FwScheduler(lpad)
+    scheduler.set_transport(AttributeDict({'_machine': 'localhost'}))
+    # No max_requeues in the settings of the computer
+    scheduler._settings = {}  # pylint: disable=protected-access
+    _LAST_MAINTENANCE.clear()
+    jobs = scheduler.get_jobs(jobs=[str(job_id)], as_dict=True)
+    assert jobs[str(job_id)].job_state == JobState.QUEUED
+    assert lpad.get_fw_dict_by_id(job_id)['spec']['_aiida_job_info'][
+        'requeues'] == 1
 
     # Clean up the tempdiretory
     shutil.rmtree(str(ldir))
@@ -320,3 +505,15 @@ def test_submit_job(clean_launchpad, clear_database_auto):
 
     fw_ids = clean_launchpad.get_fw_ids({})
     assert fw_ids[0] == 1
+
+    # Submitting the same job again gives the existing Firework
+    assert scheduler.submit_from_script('foo', '_aiidasubmit.sh') == '1'
+    assert len(clean_launchpad.get_fw_ids({})) == 1
+
+    # The submission is refused once the computer has too many queued jobs
+    scheduler._settings = {'max_queued': 2}
+    assert scheduler.submit_from_script('bar', '_aiidasubmit.sh') == '2'
+    with pytest.raises(SchedulerError):
+        scheduler.submit_from_script('baz', '_aiidasubmit.sh')
+    # A job submitted already is still found at the limit
+    assert scheduler.submit_from_script('bar', '_aiidasubmit.sh') == '2'
@@ -0,0 +1,39 @@
+"""
+Tests for grouping the jobs into workflows
+"""
+from datetime import datetime, timedelta
+
+from aiida_fireworks_scheduler.grouping import add_grouped_firework
+
+
+def test_add_grouped_firework(clean_launchpad, make_job):
+    """Test adding jobs to the open group of the computer"""
+    lpad = clean_launchpad
+    now = datetime.utcnow()
+    fw_ids = [
+        add_grouped_firework(lpad, make_job(idx), 60, max_size=3, now=now)
+        for idx in range(4)
+    ]
+    other = add_grouped_firework(lpad,
+                                 make_job(4, computer_id='remote'),
+                                 60,
+                                 max_size=3,
+                                 now=now)
+    late = add_grouped_firework(lpad,
+                                make_job(5),
+                                60,
+                                max_size=3,
+                                now=now + timedelta(seconds=120))
+
+    wf_doc = lpad.workflows.find_one({'nodes': fw_ids[0]})
+    assert sorted(wf_doc['nodes']) == sorted(fw_ids[:3])
+    assert wf_doc['fw_states'][str(fw_ids[2])] == 'READY'
+    assert lpad.workflows.count_documents({}) == 4
+    for fw_id in (fw_ids[3], other, late):
+        assert lpad.workflows.find_one({'nodes': fw_id})['nodes'] == [fw_id]
+
+    # Each job can still be run and defused on its own
+    assert lpad.get_fw_dict_by_id(fw_ids[1])['state'] == 'READY'
+    lpad.defuse_fw(fw_ids[1])
+    assert lpad.get_fw_dict_by_id(fw_ids[1])['state'] == 'DEFUSED'
+    assert lpad.get_fw_dict_by_id(fw_ids[2])['state'] == 'READY'
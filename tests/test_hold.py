@@ -0,0 +1,53 @@
+"""
+Tests for holding and releasing the jobs
+"""
+from aiida_fireworks_scheduler.hold import (add_workflow, hold_firework,
+                                            release_jobs, workflow_state)
+from aiida_fireworks_scheduler.grouping import add_grouped_firework
+
+
+def held_job(make_job, idx):
+    """Make the Firework of a job submitted as held"""
+    job = make_job(idx)
+    hold_firework(job)
+    return job
+
+
+def test_workflow_state():
+    """Test the state of workflows of independent jobs"""
+    assert workflow_state({'1': 'COMPLETED', '2': 'COMPLETED'}) == 'COMPLETED'
+    assert workflow_state({'1': 'COMPLETED', '2': 'READY'}) == 'RUNNING'
+    assert workflow_state({'1': 'PAUSED', '2': 'RUNNING'}) == 'PAUSED'
+    assert workflow_state({'1': 'READY', '2': 'READY'}) == 'READY'
+
+
+def test_release_jobs(clean_launchpad, make_job):
+    """Test adding held jobs and releasing them"""
+    lpad = clean_launchpad
+    jobs = [held_job(make_job, 0), held_job(make_job, 1), make_job(2)]
+    fw_ids = [list(add_workflow(lpad, job).values())[0] for job in jobs]
+    grouped = [
+        add_grouped_firework(lpad, held_job(make_job, idx), 60)
+        for idx in range(3, 5)
+    ]
+
+    assert lpad.get_fw_dict_by_id(fw_ids[0])['state'] == 'PAUSED'
+    assert lpad.get_fw_dict_by_id(fw_ids[2])['state'] == 'READY'
+    assert lpad.workflows.find_one({'nodes': grouped[1]})['state'] == 'PAUSED'
+
+    assert release_jobs(lpad, fw_ids=[fw_ids[0]]) == [fw_ids[0]]
+    assert lpad.get_fw_dict_by_id(fw_ids[0])['state'] == 'READY'
+    assert lpad.workflows.find_one({'nodes': fw_ids[0]})['state'] == 'READY'
+    assert lpad.get_fw_dict_by_id(fw_ids[1])['state'] == 'PAUSED'
+
+    # Jobs paused by an operator are not released
+    lpad.pause_fw(fw_ids[2])
+    assert release_jobs(lpad, fw_ids=[fw_ids[2]]) == []
+    assert sorted(release_jobs(lpad)) == sorted([fw_ids[1]] + grouped)
+    assert lpad.get_fw_dict_by_id(fw_ids[2])['state'] == 'PAUSED'
+    wf_doc = lpad.workflows.find_one({'nodes': grouped[0]})
+    assert wf_doc['state'] == 'READY'
+    assert set(wf_doc['fw_states'].values()) == {'READY'}
+    # The grouped workflows are updated while holding their locks
+    assert 'locked' not in wf_doc
+    assert release_jobs(lpad) == []
@@ -0,0 +1,76 @@
+"""
+Tests for the launchpad helpers
+"""
+import pytest
+
+from aiida_fireworks_scheduler.launchpads import (get_launchpad,
+                                                  get_read_collection,
+                                                  AiiDALaunchPad, QuerySequence,
+                                                  explain_checkout)
+
+TESTDB_URI = "mongodb://localhost:27017/aiida-fireworks-scheduler-test"
+
+
+def test_get_launchpad(launchpad):
+    """Test that launchpads are shared per location"""
+    _ = launchpad
+    lpad = get_launchpad(TESTDB_URI, max_pool_size=7)
+    assert get_launchpad(TESTDB_URI) is lpad
+    assert lpad.connection.options.pool_options.max_pool_size == 7
+    assert get_launchpad(TESTDB_URI + "?appname=other") is not lpad
+
+
+def test_read_collection(launchpad):
+    """Test setting the read preference for polling"""
+    coll = get_read_collection(launchpad, 'fireworks')
+    assert coll.read_preference == launchpad.fireworks.read_preference
+
+    coll = get_read_collection(launchpad, 'fireworks', 'secondaryPreferred',
+                               120)
+    assert coll.read_preference.mongos_mode == 'secondaryPreferred'
+    assert coll.read_preference.max_staleness == 120
+
+    with pytest.raises(ValueError):
+        get_read_collection(launchpad, 'fireworks', 'foo')
+    with pytest.raises(ValueError, match='at least 90'):
+        get_read_collection(launchpad, 'fireworks', 'secondary', 30)
+
+
+def test_query_sequence(clean_launchpad, make_job):
+    """Test checking out Fireworks with alternative queries"""
+    lpad = AiiDALaunchPad.from_dict(clean_launchpad.to_dict())
+    fw_ids = {}
+    for mpinp, priority in [(4, 200), (8, 100), (16, 100), (2, 300)]:
+        job = make_job(mpinp, mpinp=mpinp, priority=priority)
+        fw_ids[mpinp] = list(lpad.add_wf(job).values())[0]
+
+    query = QuerySequence([{
+        'spec._aiida_job_info.mpinp': {
+            '$gte': 4,
+            '$lte': 8
+        }
+    }, {
+        'spec._aiida_job_info.mpinp': 16
+    }], [[('spec._aiida_job_info.mpinp', -1)], None])
+    # The largest jobs in the range go first, regardless of the priority
+    checked_out = [lpad._get_a_fw_to_run(query).fw_id for _ in range(3)]  # pylint: disable=protected-access
+    assert checked_out == [fw_ids[8], fw_ids[4], fw_ids[16]]
+    assert lpad._get_a_fw_to_run(query) is None  # pylint: disable=protected-access
+
+
+def test_explain_checkout(clean_launchpad):
+    """Test explaining the queries of a worker"""
+    query = QuerySequence([{
+        'spec._aiida_job_info.mpinp': 4
+    }, {
+        'spec._aiida_job_info.mpinp': 16
+    }], [[('spec._aiida_job_info.mpinp', -1)], None])
+    summaries = explain_checkout(clean_launchpad, query)
+    assert len(summaries) == 2
+    assert summaries[0]['query'] == {
+        'spec._aiida_job_info.mpinp': 4,
+        'state': 'READY'
+    }
+    for summary in summaries:
+        assert summary['indexes']
+        assert summary['returned'] == 0
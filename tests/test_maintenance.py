@@ -0,0 +1,112 @@
+"""
+Tests for the maintenance of the jobs
+"""
+from datetime import datetime, timedelta
+
+from fireworks.core.firework import FWAction
+from fireworks.core.fworker import FWorker
+
+from aiida_fireworks_scheduler.jobs import JobTimeoutError
+from aiida_fireworks_scheduler.launchpads import AiiDALaunchPad
+from aiida_fireworks_scheduler.maintenance import (age_priorities,
+                                                   recover_lost_jobs,
+                                                   requeue_timed_out_jobs,
+                                                   LOST_FIELD, REQUEUED_FIELD)
+from aiida_fireworks_scheduler.fwscheduler import FwScheduler
+
+
+def test_age_priorities(clean_launchpad, make_job):
+    """Test raising the priority of the waiting jobs"""
+    lpad = clean_launchpad
+    fw_ids = []
+    for idx in range(2):
+        job = make_job(idx)
+        fw_ids.extend(lpad.add_wf(job).values())
+    lpad.fireworks.update_one({'fw_id': fw_ids[1]},
+                              {'$set': {
+                                  'state': 'RUNNING'
+                              }})
+
+    now = datetime.utcnow()
+    assert age_priorities(lpad, 3600, now=now) == 0
+    # Two levels at once
+    assert age_priorities(lpad, 3600, now=now + timedelta(hours=2.5)) == 2
+    # Repeating the update does nothing
+    assert age_priorities(lpad, 3600, now=now + timedelta(hours=2.7)) == 0
+    assert lpad.get_fw_dict_by_id(fw_ids[0])['spec']['_priority'] == 120
+    # Limited to the maximum number of levels
+    age_priorities(lpad, 3600, max_levels=5, now=now + timedelta(hours=20))
+    assert lpad.get_fw_dict_by_id(fw_ids[0])['spec']['_priority'] == 150
+    # Running jobs are not changed
+    assert lpad.get_fw_dict_by_id(fw_ids[1])['spec']['_priority'] == 100
+
+
+def test_recover_lost_jobs(clean_launchpad, tmp_path, make_job):
+    """Test recovering the jobs whose lease has expired"""
+    lpad = AiiDALaunchPad.from_dict(clean_launchpad.to_dict())
+    lpad.lease_seconds = 600
+    fw_ids = []
+    for idx in range(3):
+        job = make_job(idx)
+        fw_ids.extend(lpad.add_wf(job).values())
+    launch_ids = [
+        lpad.checkout_fw(FWorker(), str(tmp_path), fw_id=fw_id)[1]
+        for fw_id in fw_ids[:2]
+    ]
+    lpad.complete_launch(launch_ids[1], FWAction())
+    assert list(lpad._leased) == [launch_ids[0]]  # pylint: disable=protected-access
+
+    now = datetime.utcnow()
+    assert recover_lost_jobs(lpad, now=now) == []
+    assert recover_lost_jobs(lpad, now=now + timedelta(minutes=20)) == [
+        fw_ids[0]
+    ]
+    assert lpad.get_fw_dict_by_id(fw_ids[0])['state'] == 'READY'
+    assert lpad.get_launch_by_id(launch_ids[0]).state == 'FIZZLED'
+    assert lpad.get_fw_dict_by_id(fw_ids[1])['state'] == 'COMPLETED'
+    assert recover_lost_jobs(lpad, now=now + timedelta(minutes=20)) == []
+
+    # Jobs not run again are reported to AiiDA as failed
+    lpad.checkout_fw(FWorker(), str(tmp_path), fw_id=fw_ids[2])
+    assert recover_lost_jobs(lpad, rerun=False,
+                             now=now + timedelta(hours=1)) == [fw_ids[2]]
+    assert recover_lost_jobs(lpad, rerun=False,
+                             now=now + timedelta(hours=1)) == []
+    fw_dict = lpad.fireworks.find_one({'fw_id': fw_ids[2]})
+    assert fw_dict['state'] == 'FIZZLED'
+    assert fw_dict[LOST_FIELD]
+    scheduler = FwScheduler(lpad)
+    detailed_job_info = scheduler.get_detailed_job_info(str(fw_ids[2]))
+    assert scheduler.parse_output(detailed_job_info).status == 140
+
+
+def test_requeue_timed_out_jobs(clean_launchpad, tmp_path, make_job):
+    """Test that each timed out launch is handled once, by its own computer"""
+    lpad = clean_launchpad
+    fw_ids = []
+    launch_ids = []
+    for computer_id in ['localhost', 'remote']:
+        job = make_job(computer_id, computer_id=computer_id, max_requeues=1)
+        fw_id = list(lpad.add_wf(job).values())[0]
+        launch_id = lpad.checkout_fw(FWorker(), str(tmp_path), fw_id=fw_id)[1]
+        error = JobTimeoutError(1800, computer_id)
+        lpad.complete_launch(
+            launch_id,
+            FWAction(stored_data={'_exception': {
+                '_details': error.to_dict()
+            }}), 'FIZZLED')
+        fw_ids.append(fw_id)
+        launch_ids.append(launch_id)
+
+    assert requeue_timed_out_jobs(lpad, computer_id='remote') == [fw_ids[1]]
+    assert lpad.get_fw_dict_by_id(fw_ids[1])['state'] == 'READY'
+    assert lpad.get_fw_dict_by_id(
+        fw_ids[1])['spec']['_aiida_job_info']['walltime'] == 2700
+    assert REQUEUED_FIELD not in lpad.launches.find_one(
+        {'launch_id': launch_ids[0]})
+
+    # The launch of a job that cannot be requeued is only marked as handled
+    lpad.archive_wf(fw_ids[0])
+    assert requeue_timed_out_jobs(lpad, computer_id='localhost') == []
+    assert lpad.launches.find_one({'launch_id': launch_ids[0]})[REQUEUED_FIELD]
+    assert requeue_timed_out_jobs(lpad) == []
@@ -0,0 +1,54 @@
+"""
+Tests for the placement of concurrently running jobs
+"""
+import os
+import subprocess
+
+from aiida_fireworks_scheduler.placement import acquire_cpus, release, \
+    format_cpu_list, parse_cpu_list, acquire_slots, write_hostfile
+
+
+def test_cpu_list():
+    """Test converting the CPU lists"""
+    assert format_cpu_list([8, 0, 1, 2, 3, 10, 11]) == '0-3,8,10-11'
+    assert parse_cpu_list('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+
+
+def test_acquire_cpus(tmp_path):
+    """Test acquiring and releasing disjoint sets of CPUs"""
+    # The launcher creates the state file empty
+    state = str(tmp_path / 'state.json')
+    (tmp_path / 'state.json').touch()
+    proc = subprocess.Popen(['sleep', '30'])
+    assert acquire_cpus(state, 4, proc.pid, cpus=range(8)) == [0, 1, 2, 3]
+    assert acquire_cpus(state, 3, os.getpid(), cpus=range(8)) == [4, 5, 6]
+    assert acquire_cpus(state, 2, os.getpid(), cpus=range(8)) is None
+
+    # The CPUs of finished processes are free to use
+    proc.kill()
+    proc.wait()
+    assert acquire_cpus(state, 2, 1, cpus=range(8)) == [0, 1]
+
+    release(state, os.getpid())
+    assert acquire_cpus(state, 6, os.getpid(), cpus=range(8)) == [2, 3, 4, 5, 6, 7]
+
+
+def test_acquire_slots(tmp_path):
+    """Test splitting the nodes of an allocation between jobs"""
+    state = str(tmp_path / 'state.json')
+    nodes = ['n1', 'n2', 'n3']
+    proc = subprocess.Popen(['sleep', '30'])
+    # Small jobs are packed on partially used nodes
+    assert acquire_slots(state, nodes, 4, 2, proc.pid) == [('n1', 2)]
+    assert acquire_slots(state, nodes, 4, 2, 1) == [('n1', 2)]
+    # Large jobs take whole nodes
+    assert acquire_slots(state, nodes, 4, 6, os.getpid()) == [('n2', 4),
+                                                             ('n3', 2)]
+    assert acquire_slots(state, nodes, 4, 3, os.getppid()) is None
+    proc.kill()
+    proc.wait()
+    assert acquire_slots(state, nodes, 4, 2, os.getppid()) == [('n1', 2)]
+
+    hostfile = tmp_path / 'hostfile'
+    write_hostfile(str(hostfile), [('n2', 2), ('n3', 1)])
+    assert hostfile.read_text().split() == ['n2', 'n2', 'n3']
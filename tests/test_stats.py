@@ -0,0 +1,34 @@
+"""
+Tests for the statistics of the jobs
+"""
+from datetime import datetime, timedelta
+
+from aiida_fireworks_scheduler.stats import get_stats
+
+
+def test_get_stats(clean_launchpad, make_job):
+    """Test counting the jobs in a single aggregation"""
+    lpad = clean_launchpad
+    for idx, (mpinp, walltime) in enumerate([(2, 1800), (2, 3000), (4, 7200),
+                                             (4, 300000)]):
+        job = make_job(idx, walltime=walltime, mpinp=mpinp)
+        lpad.add_wf(job)
+
+    rows = get_stats(lpad, now=datetime.utcnow() + timedelta(hours=1))
+    assert len(rows) == 3
+    assert rows[0]['mpinp'] == 2
+    assert rows[0]['walltime_bucket'] == 3600
+    assert rows[0]['state'] == 'READY'
+    assert rows[0]['count'] == 2
+    assert rows[0]['core_seconds'] == 2 * (1800 + 3000)
+    assert 3500 < rows[0]['oldest_age'] < 3700
+    # Jobs longer than the last bucket have no upper bound
+    assert {row['walltime_bucket'] for row in rows[1:]} == {4 * 3600, None}
+
+    assert not get_stats(lpad, states=['COMPLETED'])
+    assert not get_stats(lpad, computer_id='remote')
+
+    # Times without microseconds are stored without the fraction
+    lpad.fireworks.update_many({}, {'$set': {'created_on': '2020-01-01T10:00:00'}})
+    rows = get_stats(lpad, now=datetime(2020, 1, 1, 11))
+    assert rows[0]['oldest_age'] == 3600
@@ -0,0 +1,23 @@
+"""
+Tests for the resource usage sampling
+"""
+import json
+import subprocess
+import sys
+
+from aiida_fireworks_scheduler.usage import monitor
+
+
+def test_monitor(tmp_path):
+    """Test sampling the usage of a process tree"""
+    code = "x = bytearray(100 * 1024 ** 2)\nimport time\nt = time.time()\nwhile time.time() - t < 2: pass"
+    proc = subprocess.Popen(['bash', '-c', f'"{sys.executable}" -c "{code}"'])
+    output = tmp_path / 'usage.json'
+    monitor(proc.pid, 0.5, str(output))
+    proc.wait()
+
+    usage = json.loads(output.read_text())
+    assert usage['nsamples'] >= 2
+    assert usage['max_procs'] >= 1
+    assert usage['cpu_seconds'] > 1
+    assert usage['peak_rss_mb'] > 100
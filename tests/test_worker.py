@@ -1,9 +1,13 @@
 """
 Test the AiiDAFWorker
 """
+import os
+import pickle
+import tempfile
 
 import pytest
 from aiida_fireworks_scheduler.fworker import AiiDAFWorker, DEFAULT_USERNAME
+from aiida_fireworks_scheduler.launchpads import AiiDALaunchPad
 # pylint: disable=redefined-outer-name
 
 
@@ -19,23 +23,19 @@ def test_worker_query(worker):
 
     assert "$or" in query
 
-    fw_query = query["$or"][1]['$and'][0]
-    fw_walltime_query = query["$or"][1]['$and'][1]
-    aiida_query = query["$or"][0]
+    # The AiiDA jobs are tried first, then the other Fireworks
+    aiida_query, fw_query = query.queries
 
     assert fw_query['spec._category']['$ne'] == 'AIIDA_RESERVED_CATEGORY'
     assert fw_query['spec._category']['$eq'] == 'test'
-    assert fw_walltime_query['$or'][0] == {
-        'spec._walltime_seconds': {
-            '$exists': False
-        }
-    }
-    assert fw_walltime_query['$or'][1] == {
-        'spec._walltime_seconds': {
-            '$lt': 2591940
+    assert fw_query['spec._fworker'] == {'$in': [None, worker.name]}
+    assert fw_query['spec._walltime_seconds'] == {
+        '$not': {
+            '$gte': 2591940
         }
     }
 
+    assert aiida_query['spec._category'] == 'AIIDA_RESERVED_CATEGORY'
     assert aiida_query['spec._aiida_job_info.walltime'][
         '$lt'] == worker.sch_aware.get_remaining_seconds(
         ) - worker.SECONDS_SAFE_INTERVAL
@@ -44,6 +44,96 @@ def test_worker_query(worker):
     assert aiida_query['spec._aiida_job_info.username'] == 'user'
 
 
+def test_worker_query_cache(worker):
+    """Test that the query is only rebuilt when the walltime bucket changes"""
+    worker.sch_aware.get_remaining_seconds = lambda: 3725
+    query = worker.query
+    assert query.queries[0]['spec._aiida_job_info.walltime']['$lt'] == 3660
+    worker.sch_aware.get_remaining_seconds = lambda: 3721
+    assert worker.query is query
+    worker.sch_aware.get_remaining_seconds = lambda: 3715
+    assert worker.query is not query
+    assert worker.query.queries[1]['spec._walltime_seconds'] == {
+        '$not': {
+            '$gte': 3600
+        }
+    }
+
+
+def test_worker_query_cache_pickled(worker):
+    """Test that the compiled query survives the pickled copies of arlaunch multi"""
+    lpad = AiiDALaunchPad()
+    kept = lpad.keep_worker(pickle.loads(pickle.dumps(worker)))
+    query = kept.query
+    # Each call through the DataServer proxy receives a fresh copy of the worker
+    copy = pickle.loads(pickle.dumps(worker))
+    assert copy.query is not query
+    assert lpad.keep_worker(copy) is kept
+    assert kept.query is query
+
+
+def test_worker_checkout_order():
+    """Test trying the other Fireworks before the AiiDA jobs"""
+    worker = AiiDAFWorker("localhost", mpinp=4, checkout_order='fireworks')
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    assert worker2.checkout_order == 'fireworks'
+    query = worker2.query
+    assert 'spec._fworker' in query.queries[0]
+    assert query.queries[1]['spec._aiida_job_info.mpinp'] == 4
+    assert query.sorts == [None, None]
+
+    with pytest.raises(ValueError):
+        AiiDAFWorker("localhost", mpinp=4, checkout_order='foo')
+
+
+def test_worker_mpinp_range():
+    """Test selecting jobs with a range of MPI processes"""
+    worker = AiiDAFWorker("localhost", mpinp=32, min_mpinp=16)
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    query = worker2.query
+    assert query.queries[0]['spec._aiida_job_info.mpinp'] == {
+        '$gte': 16,
+        '$lte': 32
+    }
+    assert query.sorts[0] == [('spec._aiida_job_info.mpinp', -1)]
+
+    worker = AiiDAFWorker("localhost", mpinp=0, max_mpinp=8)
+    assert worker.mpinp_range == {'$gte': 1, '$lte': 8}
+
+
+def test_worker_computers():
+    """Test selecting jobs of several computers"""
+    worker = AiiDAFWorker("localhost",
+                          mpinp=2,
+                          username='user',
+                          computers=[['cluster', 'user']])
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    aiida_query = worker2.query['$or'][0]
+    assert aiida_query['spec._aiida_job_info.computer_id'] == {
+        '$in': ['localhost', 'cluster']
+    }
+    assert aiida_query['spec._aiida_job_info.username'] == 'user'
+
+    worker = AiiDAFWorker("localhost",
+                          mpinp=2,
+                          username='user',
+                          computers=[['cluster', 'other']])
+    assert worker.usernames == ['user', 'other']
+    assert worker.get_job_condition() == {
+        '$or': [{
+            'spec._aiida_job_info.computer_id': 'localhost',
+            'spec._aiida_job_info.username': 'user'
+        }, {
+            'spec._aiida_job_info.computer_id': 'cluster',
+            'spec._aiida_job_info.username': 'other'
+        }]
+    }
+    assert worker.get_job_condition('other') == {
+        'spec._aiida_job_info.computer_id': 'cluster',
+        'spec._aiida_job_info.username': 'other'
+    }
+
+
 def test_worker_serialise(worker):
     """Test serialiseation of the worker"""
 
@@ -55,3 +145,34 @@ def test_worker_serialise(worker):
     worker_dict.pop("username")
     worker2 = AiiDAFWorker.from_dict(worker_dict)
     assert worker2.username == DEFAULT_USERNAME
+    assert worker2.stage_dir is None
+    assert worker2.get_runtime_env() == {}
+
+
+def test_worker_runtime_env():
+    """Test the environment variables set for the jobs"""
+    worker = AiiDAFWorker("localhost", mpinp=4, stage_dir='$FOO/bar')
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    os.environ['FOO'] = '/tmp'
+    assert worker2.get_runtime_env() == {'AIIDA_FW_STAGE_DIR': '/tmp/bar'}
+    os.environ.pop('FOO')
+
+
+def test_worker_env_cache():
+    """Test the login environment cache location"""
+    worker = AiiDAFWorker("localhost", mpinp=4, cache_login_env=True)
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    assert worker2.cache_login_env
+    # The cache is only kept in a directory private to the launcher
+    assert 'AIIDA_FW_ENV_CACHE' not in worker2.get_runtime_env()
+    private_dir = tempfile.mkdtemp()
+    cache = worker2.get_runtime_env(private_dir)['AIIDA_FW_ENV_CACHE']
+    assert os.path.dirname(cache) == private_dir
+    os.rmdir(private_dir)
+
+
+def test_worker_usage_interval():
+    """Test enabling the usage sampling"""
+    worker = AiiDAFWorker("localhost", mpinp=4, usage_interval=30)
+    worker2 = AiiDAFWorker.from_dict(worker.to_dict())
+    assert worker2.get_runtime_env() == {'AIIDA_FW_USAGE_INTERVAL': '30'}